@@ -6,138 +6,331 @@ then builds chart data structures accordingly.
 """
 import json
 import logging
-from typing import Dict, Any, List
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache, partial
+from typing import Dict, Any, List, Tuple
 
-from app.llm import call_llm
+import numpy as np
+from pydantic import ValidationError
+
+from app import jsonutil
+from app.llm import acall_llm_until_json, call_llm_until_json
+from app.llm_cache import acached_call_llm, cached_call_llm
+from app.schemas import ChartPlan
 
 logger = logging.getLogger(__name__)
 
 
+# Only these metrics can be rendered by build_chart_data_from_plan
+SUPPORTED_METRICS = frozenset({"revenue", "net_profit", "total_assets", "total_liabilities"})
+
+# Years of metrics shown to the planner (most recent first to be kept)
+PLANNER_MAX_YEARS = 5
+
+# Parsed LLM plans kept in memory, keyed by (question, metrics summary)
+PLAN_CACHE_SIZE = 256
+
+
+def _metrics_signature(metrics_by_year: Dict[int, Dict[str, float]]) -> Tuple[Tuple[int, Tuple[str, ...]], ...]:
+    """Hashable (year, metric names) signature of the most recent years' supported metrics."""
+    recent = sorted(metrics_by_year)[-PLANNER_MAX_YEARS:]
+    return tuple(
+        (year, tuple(sorted(SUPPORTED_METRICS.intersection(metrics_by_year[year]))))
+        for year in recent
+    )
+
+
+@lru_cache(maxsize=128)
+def _build_summary(signature: Tuple[Tuple[int, Tuple[str, ...]], ...]) -> str:
+    lines = [f"{year}: {', '.join(metric_names)}" for year, metric_names in signature if metric_names]
+    return "\n".join(lines) if lines else "No metrics available."
+
+
 def build_metrics_summary_for_planner(metrics_by_year: Dict[int, Dict[str, float]]) -> str:
     """
     Convert metrics_by_year dict into a short, planner-friendly text.
+    Memoized on the (year, metric names) signature, which only changes on upload.
+    
+    Only the last PLANNER_MAX_YEARS years and the SUPPORTED_METRICS are listed:
+    the planner only needs to know which metrics exist, and anything else could
+    not be charted anyway. Years left with no supported metric are dropped.
     
     Example:
-      2023: revenue, net_profit, total_assets, total_liabilities
-      2024: revenue, net_profit, total_assets, total_liabilities
+      2023: net_profit, revenue, total_assets, total_liabilities
+      2024: net_profit, revenue, total_assets, total_liabilities
     """
     if not metrics_by_year:
         return "No metrics available."
     
-    lines = []
-    for year in sorted(metrics_by_year.keys()):
-        metric_names = sorted(metrics_by_year[year].keys())
-        if metric_names:
-            lines.append(f"{year}: {', '.join(metric_names)}")
-    
-    return "\n".join(lines) if lines else "No metrics available."
+    return _build_summary(_metrics_signature(metrics_by_year))
 
 
-def plan_chart_config(user_question: str, metrics_by_year: Dict[int, Dict[str, float]]) -> Dict[str, Any]:
-    """
-    Use Gemini (via call_llm) to decide chart config:
-      - wants_chart: bool
-      - chart_type: "line" | "bar" | "pie" | "none"
-      - x_axis: "year" or "metric"
-      - metrics: list of metric names (e.g. ["revenue", "net_profit"])
-      - aggregation: e.g. "none" or "latest_year"
-    """
-    metrics_summary = build_metrics_summary_for_planner(metrics_by_year)
-    
-    system_prompt = """You are a chart planning assistant for a financial dashboard.
+_NO_CHART_PLAN: Dict[str, Any] = {
+    "wants_chart": False,
+    "chart_type": "none",
+    "x_axis": "year",
+    "metrics": [],
+    "aggregation": "none",
+}
 
-You receive:
-1) A user's question about financial performance.
-2) A summary of what metrics are available by year, such as:
-   2023: revenue, net_profit, total_assets, total_liabilities
-   2024: revenue, net_profit, total_assets, total_liabilities
 
-Your job is to decide IF a chart should be shown, WHAT metrics to plot, and WHAT chart type is appropriate.
+# Fixed planner instructions, kept terse and byte-identical across requests so
+# the provider-side prefix cache can reuse them.
+PLANNER_SYSTEM_PROMPT = """You are a chart planner for a financial dashboard.
+Input: a user question and the metrics available per year ("<year>: <metric>, ...").
+Decide IF a chart is shown, WHICH metrics, and WHICH type.
 
-Chart types you can choose:
-- "line": for trends over time (e.g. revenue by year).
-- "bar": for comparing values across years or across metrics.
-- "pie": for showing composition of one year's metrics (e.g. assets vs liabilities).
-
-If the user asks for a "flow chart" or "flowchart", you MUST set chart_type to "none".
-We do NOT support actual flowchart visuals; the main assistant will answer with text steps instead.
+Types:
+- line: trend over years.
+- bar: compare values across years or metrics.
+- pie: composition of one year's metrics (e.g. assets vs liabilities).
 
 Rules:
-- If the question does not explicitly ask to show/plot/visualize/graph/chart/draw something, set "wants_chart" to false.
-- Only use metrics that actually exist in the metrics summary.
-- If the user mentions a specific chart type (bar, line, pie), prefer that type.
-- If the question is about trends over years → line chart is usually best.
-- If the question is about comparing a few values in specific years → bar chart is good.
-- If the question is about showing share or distribution for a single year → pie chart is good.
-- If a chart would add no value, set "wants_chart" to false.
-
-Return ONLY valid JSON with keys:
-  "wants_chart": boolean,
-  "chart_type": string, one of "line", "bar", "pie", "none"
-  "x_axis": string, either "year" or "metric"
-  "metrics": array of metric names (like ["revenue", "net_profit"])
-  "aggregation": string, e.g. "none" or "latest_year"
+- wants_chart=false unless the question explicitly asks to show/plot/visualize/graph/chart/draw, or if a chart adds no value.
+- "flow chart"/"flowchart": chart_type="none" (unsupported; answered in text).
+- Use only metrics listed in the summary.
+- Prefer a chart type the user names.
+- Otherwise: trend over years -> line; comparing a few values in specific years -> bar; share/distribution in one year -> pie.
+
+Return ONLY JSON:
+{"wants_chart": bool, "chart_type": "line"|"bar"|"pie"|"none", "x_axis": "year"|"metric", "metrics": [metric names], "aggregation": "none"|"latest_year"}
 """
 
-    user_prompt = f"""User's question:
-\"\"\"{user_question}\"\"\"
+# Constrain Gemini to emit exactly the ChartPlan JSON shape
+PLANNER_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": ChartPlan,
+}
+
 
-Available metrics by year:
+def _build_planner_prompts(
+    user_question: str, metrics_by_year: Dict[int, Dict[str, float]]
+) -> Tuple[str, str, str]:
+    """
+    Returns (system_prompt, user_prompt, metrics_summary) for the chart planner.
+    """
+    metrics_summary = build_metrics_summary_for_planner(metrics_by_year)
+    
+    # Static/slow-changing content first (metrics), the question last
+    user_prompt = f"""Available metrics by year:
 {metrics_summary}
 
+User's question:
+\"\"\"{user_question}\"\"\"
+
 Return JSON only.
 """
+    return PLANNER_SYSTEM_PROMPT, user_prompt, metrics_summary
+
 
+def _parse_plan(raw: str) -> Dict[str, Any] | None:
+    """
+    Parse and validate the planner's raw LLM output into a chart config.
+    Returns None if the output isn't JSON.
+    """
     try:
-        raw = call_llm(system_prompt, user_prompt)
-        
-        # Try to extract JSON
+        # Structured output: the response is exactly a ChartPlan object
+        config = ChartPlan.model_validate_json(raw).model_dump()
+    except ValidationError:
+        # Non-schema responses (e.g. cached before structured output): extract JSON
         try:
             start = raw.index("{")
             end = raw.rindex("}") + 1
             json_str = raw[start:end]
-            config = json.loads(json_str)
+            config = jsonutil.loads(json_str)
         except (ValueError, json.JSONDecodeError) as e:
             logger.warning(f"Failed to parse chart planner JSON: {e}. Response: {raw[:200]}")
-            # Fallback conservative config: no chart
-            return {
-                "wants_chart": False,
-                "chart_type": "none",
-                "x_axis": "year",
-                "metrics": [],
-                "aggregation": "none",
-            }
-        
-        # Basic validation & defaults
-        wants_chart = bool(config.get("wants_chart"))
-        chart_type = config.get("chart_type") or "none"
-        x_axis = config.get("x_axis") or "year"
-        metrics = config.get("metrics") or []
-        aggregation = config.get("aggregation") or "none"
-        
-        # If chart_type invalid, force none
-        if chart_type not in ("line", "bar", "pie"):
-            chart_type = "none"
-            wants_chart = False
-        
-        return {
-            "wants_chart": wants_chart,
-            "chart_type": chart_type,
-            "x_axis": x_axis,
-            "metrics": metrics,
-            "aggregation": aggregation,
-        }
-        
+            return None
+    
+    # Basic validation & defaults
+    wants_chart = bool(config.get("wants_chart"))
+    chart_type = config.get("chart_type") or "none"
+    x_axis = config.get("x_axis") or "year"
+    metrics = config.get("metrics") or []
+    aggregation = config.get("aggregation") or "none"
+    
+    # If chart_type invalid, force none
+    if chart_type not in ("line", "bar", "pie"):
+        chart_type = "none"
+        wants_chart = False
+    
+    return {
+        "wants_chart": wants_chart,
+        "chart_type": chart_type,
+        "x_axis": x_axis,
+        "metrics": metrics,
+        "aggregation": aggregation,
+    }
+
+
+_plan_cache: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+_plan_cache_lock = threading.Lock()
+
+
+def _cached_plan(key: Tuple[str, str]) -> Dict[str, Any] | None:
+    with _plan_cache_lock:
+        plan = _plan_cache.get(key)
+        if plan is None:
+            return None
+        _plan_cache.move_to_end(key)
+    return dict(plan)
+
+
+def _remember_plan(key: Tuple[str, str], plan: Dict[str, Any]) -> Dict[str, Any]:
+    with _plan_cache_lock:
+        _plan_cache[key] = dict(plan)
+        while len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+    return plan
+
+
+def plan_chart_config(user_question: str, metrics_by_year: Dict[int, Dict[str, float]]) -> Dict[str, Any]:
+    """
+    Use Gemini (via call_llm) to decide chart config:
+      - wants_chart: bool
+      - chart_type: "line" | "bar" | "pie" | "none"
+      - x_axis: "year" or "metric"
+      - metrics: list of metric names (e.g. ["revenue", "net_profit"])
+      - aggregation: e.g. "none" or "latest_year"
+    Unambiguous requests are planned deterministically without the LLM, and
+    repeated questions over the same metrics reuse the earlier plan.
+    """
+    plan = _fast_plan(user_question, metrics_by_year)
+    if plan is not None:
+        return plan
+    
+    try:
+        system_prompt, user_prompt, metrics_summary = _build_planner_prompts(user_question, metrics_by_year)
+        plan = _cached_plan((user_question, metrics_summary))
+        if plan is not None:
+            return plan
+        plan = cached_call_llm(
+            system_prompt,
+            user_prompt,
+            question_key=user_question,
+            question_scope=metrics_summary,
+            llm_fn=partial(call_llm_until_json, generation_config=PLANNER_GENERATION_CONFIG),
+            parse=_parse_plan,
+        )
+        if plan is None:
+            # Unparsable output: no chart, and nothing cached
+            return dict(_NO_CHART_PLAN)
+        return _remember_plan((user_question, metrics_summary), plan)
     except Exception as e:
         logger.exception(f"Error in chart planner: {e}")
         # Fallback: no chart
-        return {
-            "wants_chart": False,
-            "chart_type": "none",
-            "x_axis": "year",
-            "metrics": [],
-            "aggregation": "none",
-        }
+        return dict(_NO_CHART_PLAN)
+
+
+async def aplan_chart_config(user_question: str, metrics_by_year: Dict[int, Dict[str, float]]) -> Dict[str, Any]:
+    """
+    Async variant of plan_chart_config so the planner can overlap with the answer call.
+    """
+    plan = _fast_plan(user_question, metrics_by_year)
+    if plan is not None:
+        return plan
+    
+    try:
+        system_prompt, user_prompt, metrics_summary = _build_planner_prompts(user_question, metrics_by_year)
+        plan = _cached_plan((user_question, metrics_summary))
+        if plan is not None:
+            return plan
+        plan = await acached_call_llm(
+            system_prompt,
+            user_prompt,
+            question_key=user_question,
+            question_scope=metrics_summary,
+            llm_fn=partial(acall_llm_until_json, generation_config=PLANNER_GENERATION_CONFIG),
+            parse=_parse_plan,
+        )
+        if plan is None:
+            # Unparsable output: no chart, and nothing cached
+            return dict(_NO_CHART_PLAN)
+        return _remember_plan((user_question, metrics_summary), plan)
+    except Exception as e:
+        logger.exception(f"Error in chart planner: {e}")
+        # Fallback: no chart
+        return dict(_NO_CHART_PLAN)
+
+
+# Normalize metric names: convert to lowercase and handle variations
+# Available metric keys in metrics_by_year are: revenue, net_profit, total_assets, total_liabilities
+METRIC_NAME_MAPPING: Dict[str, str] = {
+    "revenue": "revenue",
+    "net_profit": "net_profit",
+    "net profit": "net_profit",
+    "total_assets": "total_assets",
+    "total assets": "total_assets",
+    "assets": "total_assets",
+    "total_liabilities": "total_liabilities",
+    "total liabilities": "total_liabilities",
+    "liabilities": "total_liabilities",
+}
+
+# Longest alternatives first so "total assets" wins over "assets"
+_METRIC_KEY_RE = re.compile(
+    "|".join(re.escape(k) for k in sorted(METRIC_NAME_MAPPING, key=len, reverse=True))
+)
+
+
+@lru_cache(maxsize=256)
+def _normalize_metric_name(metric_name: str) -> str | None:
+    """
+    Map a planner-supplied metric name to a canonical metric key, or None.
+    Lowercases once, then tries exact lookup, a single regex scan for a known
+    key inside the name, and finally a partial name inside a known key ("liab").
+    """
+    lower = metric_name.lower()
+    canonical = METRIC_NAME_MAPPING.get(lower)
+    if canonical is not None:
+        return canonical
+    m = _METRIC_KEY_RE.search(lower)
+    if m:
+        return METRIC_NAME_MAPPING[m.group(0)]
+    return next((v for k, v in METRIC_NAME_MAPPING.items() if lower in k), None)
+
+
+# Deterministic fast-path for unambiguous chart requests ("plot revenue trend"):
+# an explicit chart verb, a chart-type cue and at least one known metric.
+_CHART_REQUEST_RE = re.compile(r"\b(show|plot|chart|graph|visuali[sz]e|draw)\b")
+_UNSUPPORTED_CHART_RE = re.compile(r"\bflow\s?chart")
+_FAST_CHART_TYPES: List[Tuple[re.Pattern, str]] = [
+    (re.compile(r"\b(pie|share|distribution|composition|breakdown)\b"), "pie"),
+    (re.compile(r"\b(bar|bars|compare|comparison|versus|vs)\b"), "bar"),
+    (re.compile(r"\b(line|trend|trends|over time|by year|growth|history)\b"), "line"),
+]
+
+
+def _fast_plan(user_question: str, metrics_by_year: Dict[int, Dict[str, float]]) -> Dict[str, Any] | None:
+    """
+    Return a chart plan without calling the LLM when the question is unambiguous,
+    or None to defer to the LLM planner.
+    """
+    q = user_question.lower()
+    if not _CHART_REQUEST_RE.search(q) or _UNSUPPORTED_CHART_RE.search(q):
+        return None
+    
+    chart_type = next((t for pattern, t in _FAST_CHART_TYPES if pattern.search(q)), None)
+    if chart_type is None:
+        return None
+    
+    available = {name for year_metrics in metrics_by_year.values() for name in year_metrics}
+    metrics = [
+        m for m in dict.fromkeys(METRIC_NAME_MAPPING[k] for k in _METRIC_KEY_RE.findall(q))
+        if m in available
+    ]
+    if not metrics:
+        return None
+    
+    return {
+        "wants_chart": True,
+        "chart_type": chart_type,
+        "x_axis": "year",
+        "metrics": metrics,
+        "aggregation": "latest_year" if chart_type == "pie" else "none",
+    }
 
 
 def build_chart_data_from_plan(
@@ -168,61 +361,45 @@ def build_chart_data_from_plan(
         # Fallback: treat as year-based
         x_axis = "year"
     
-    # Normalize metric names: convert to lowercase and handle variations
-    # Available metric keys in metrics_by_year are: revenue, net_profit, total_assets, total_liabilities
-    metric_name_mapping = {
-        "revenue": "revenue",
-        "net_profit": "net_profit",
-        "net profit": "net_profit",
-        "total_assets": "total_assets",
-        "total assets": "total_assets",
-        "assets": "total_assets",
-        "total_liabilities": "total_liabilities",
-        "total liabilities": "total_liabilities",
-        "liabilities": "total_liabilities",
-    }
-    
     # Normalize requested metrics
     normalized_metrics = []
     for metric_name in metrics:
-        # Try exact match first
-        if metric_name in metric_name_mapping:
-            normalized_metrics.append(metric_name_mapping[metric_name])
-        elif metric_name.lower() in metric_name_mapping:
-            normalized_metrics.append(metric_name_mapping[metric_name.lower()])
-        else:
-            # Try to find a match by checking if it's a substring
-            found = False
-            for key, value in metric_name_mapping.items():
-                if metric_name.lower() in key.lower() or key.lower() in metric_name.lower():
-                    normalized_metrics.append(value)
-                    found = True
-                    break
-            if not found:
-                # Try direct lookup in first year's metrics
-                first_year = years[0]
-                if metric_name in metrics_by_year.get(first_year, {}):
-                    normalized_metrics.append(metric_name)
+        canonical = _normalize_metric_name(metric_name)
+        if canonical is not None:
+            normalized_metrics.append(canonical)
+        elif metric_name in metrics_by_year.get(years[0], {}):
+            # Try direct lookup in first year's metrics
+            normalized_metrics.append(metric_name)
     
     # Remove duplicates while preserving order
-    seen = set()
-    normalized_metrics = [m for m in normalized_metrics if m not in seen and not seen.add(m)]
+    normalized_metrics = list(dict.fromkeys(normalized_metrics))
     
     if not normalized_metrics:
         return None
     
+    # Dense (metric x year) matrix built in one pass over the populated cells;
+    # `present` distinguishes a missing value from a reported 0.0
+    metric_idx = {m: i for i, m in enumerate(normalized_metrics)}
+    arr = np.zeros((len(normalized_metrics), len(years)), dtype=np.float64)
+    present = np.zeros(arr.shape, dtype=bool)
+    for j, y in enumerate(years):
+        for metric_name, val in metrics_by_year[y].items():
+            i = metric_idx.get(metric_name)
+            if i is not None and val is not None:
+                arr[i, j] = val
+                present[i, j] = True
+    
     # If aggregation == "latest_year" and chart_type == "pie", we only use the latest year
     if chart_type == "pie":
         target_year = years[-1]  # Use latest year
-        series = []
-        
-        for metric_name in normalized_metrics:
-            val = metrics_by_year.get(target_year, {}).get(metric_name)
-            if val is not None:
-                series.append({
-                    "label": metric_name.replace("_", " ").title(),
-                    "values": [val],  # we'll use only index 0 in the frontend
-                })
+        series = [
+            {
+                "label": metric_name.replace("_", " ").title(),
+                "values": [float(arr[i, -1])],  # we'll use only index 0 in the frontend
+            }
+            for i, metric_name in enumerate(normalized_metrics)
+            if present[i, -1]
+        ]
         
         if not series:
             return None
@@ -233,20 +410,17 @@ def build_chart_data_from_plan(
             "series": series,
         }
     
-    # For line/bar: build series across years
-    series = []
-    for metric_name in normalized_metrics:
-        values = []
-        for y in years:
-            val = metrics_by_year.get(y, {}).get(metric_name)
-            values.append(val if val is not None else 0.0)
-        
-        # Only add series if at least one value is non-zero
-        if any(v != 0.0 for v in values):
-            series.append({
-                "label": metric_name.replace("_", " ").title(),
-                "values": values,
-            })
+    # For line/bar: build series across years (missing values plotted as 0.0).
+    # Only add series if at least one value is non-zero
+    nonzero = arr.any(axis=1)
+    series = [
+        {
+            "label": metric_name.replace("_", " ").title(),
+            "values": arr[i].tolist(),
+        }
+        for i, metric_name in enumerate(normalized_metrics)
+        if nonzero[i]
+    ]
     
     if not series:
         return None
@@ -256,4 +430,3 @@ def build_chart_data_from_plan(
         "years": years,
         "series": series,
     }
-
@@ -6,6 +6,11 @@ class Settings(BaseSettings):
     GEMINI_MODEL: str = "gemini-1.5-flash"
     GEMINI_EMBEDDING_MODEL: str = "models/text-embedding-004"
     DATABASE_URL: str = "sqlite:///./balancesheet.db"
+    LLM_CACHE_DIR: str = "data/llm_cache"
+    # Worker threads for blocking work (sync deps, PDF parsing, Gemini SDK calls)
+    THREAD_POOL_SIZE: int = 32
+    # Worker processes for page extraction on large PDFs (0 = one per CPU, 1 = in-process)
+    PDF_EXTRACT_PROCESSES: int = 0
 
     class Config:
         env_file = ".env"
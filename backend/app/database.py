@@ -1,13 +1,31 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 from app.config import settings
 
+# Room for every statement the app issues; the chat path re-runs the same
+# parameterized metric queries on each turn and reuses their compiled SQL
 engine = create_engine(
     settings.DATABASE_URL,
+    query_cache_size=1200,
     connect_args={"check_same_thread": False}
     if settings.DATABASE_URL.startswith("sqlite")
     else {},
 )
+
+
+if settings.DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets the document list and chat read while a background parse writes;
+        # synchronous=NORMAL is durable enough under WAL and far cheaper per commit
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -0,0 +1,25 @@
+"""
+JSON helpers backed by orjson when it is installed, falling back to stdlib json.
+
+orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers can keep
+catching the stdlib exception either way.
+"""
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+
+def loads(data: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(obj)
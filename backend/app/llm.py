@@ -1,118 +1,417 @@
-import google.generativeai as genai
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cache, lru_cache
+from typing import TYPE_CHECKING
+import numpy as np
 from app.config import settings
 import logging
 
-genai.configure(api_key=settings.GEMINI_API_KEY)
+if TYPE_CHECKING:
+    import google.generativeai as genai
+
 logger = logging.getLogger(__name__)
 
+# Bound in-flight async Gemini calls to stay within provider rate limits
+_llm_semaphore = asyncio.Semaphore(8)
+
+# Concurrent embedding batches per embed_texts call
+EMBED_MAX_WORKERS = 4
+
+# BatchEmbedContents accepts at most 100 requests per call
+EMBED_BATCH_SIZE = 100
+
+
+@cache
+def configure_genai():
+    """
+    Import and configure the Gemini SDK on first use rather than at import time
+    (importing it is most of the app's startup cost), returning the module.
+    """
+    import google.generativeai as genai
 
-def call_llm(system_prompt: str, user_prompt: str) -> str:
-    model = genai.GenerativeModel(
+    genai.configure(api_key=settings.GEMINI_API_KEY)
+    return genai
+
+
+@lru_cache(maxsize=32)
+def get_model(system_prompt: str) -> "genai.GenerativeModel":
+    """
+    Return a GenerativeModel for this system instruction, built once and reused.
+    All models share the SDK's process-wide client (and its HTTP/gRPC channel)
+    created by configure_genai.
+    """
+    genai = configure_genai()
+    return genai.GenerativeModel(
         model_name=settings.GEMINI_MODEL,
         system_instruction=system_prompt,
     )
+
+
+def call_llm(system_prompt: str, user_prompt: str, generation_config: dict | None = None) -> str:
+    model = get_model(system_prompt)
     try:
-        response = model.generate_content(user_prompt)
+        response = model.generate_content(user_prompt, generation_config=generation_config)
         return response.text or ""
     except Exception as e:
         logger.exception("Gemini call failed")
         return f"LLM error: {e}"
 
 
-def embed_texts(texts: list[str]) -> list[list[float]]:
+async def acall_llm(system_prompt: str, user_prompt: str, generation_config: dict | None = None) -> str:
+    """
+    Async variant of call_llm so independent calls can be awaited concurrently.
+    """
+    model = get_model(system_prompt)
+    try:
+        async with _llm_semaphore:
+            response = await model.generate_content_async(user_prompt, generation_config=generation_config)
+        return response.text or ""
+    except Exception as e:
+        logger.exception("Gemini call failed")
+        return f"LLM error: {e}"
+
+
+class JsonObjectScanner:
+    """
+    Incremental brace-depth scanner over streamed text. feed() returns the
+    end offset (exclusive) of the first complete top-level JSON object, or None.
+    Braces inside JSON strings are ignored.
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> int | None:
+        self.text += chunk
+        text = self.text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                if self._depth > 0:
+                    self._in_string = True
+            elif c == "{":
+                self._depth += 1
+            elif c == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._pos = i + 1
+                    return i + 1
+        self._pos = len(text)
+        return None
+
+
+def call_llm_until_json(system_prompt: str, user_prompt: str, generation_config: dict | None = None) -> str:
+    """
+    Stream the response and stop reading as soon as the first complete JSON
+    object has arrived. Returns the text up to that point (or the full text if
+    no object closes). Falls back to call_llm if streaming fails.
+    """
+    model = get_model(system_prompt)
+    scanner = JsonObjectScanner()
+    try:
+        for chunk in model.generate_content(user_prompt, stream=True, generation_config=generation_config):
+            end = scanner.feed(chunk.text or "")
+            if end is not None:
+                return scanner.text[:end]
+        return scanner.text
+    except Exception as e:
+        logger.warning("Streaming Gemini call failed, retrying without streaming: %s", e)
+        return call_llm(system_prompt, user_prompt, generation_config)
+
+
+async def acall_llm_until_json(system_prompt: str, user_prompt: str, generation_config: dict | None = None) -> str:
+    """
+    Async variant of call_llm_until_json.
+    """
+    model = get_model(system_prompt)
+    scanner = JsonObjectScanner()
+    try:
+        async with _llm_semaphore:
+            response = await model.generate_content_async(
+                user_prompt, stream=True, generation_config=generation_config
+            )
+            async for chunk in response:
+                end = scanner.feed(chunk.text or "")
+                if end is not None:
+                    return scanner.text[:end]
+        return scanner.text
+    except Exception as e:
+        logger.warning("Streaming Gemini call failed, retrying without streaming: %s", e)
+        return await acall_llm(system_prompt, user_prompt, generation_config)
+
+
+def _embedding_matrix(result, batch: list[str]) -> np.ndarray:
+    """
+    Convert an embed_content response for `batch` into a float32 array, one row per input.
+    """
+    # The Google Generative AI SDK returns a dict with key 'embedding' (singular)
+    # The value is a list of embedding vectors: [[vec1], [vec2], ...]
+    batch_embeddings_raw = None
+    if isinstance(result, dict):
+        batch_embeddings_raw = result.get("embedding", result.get("embeddings"))
+    elif hasattr(result, "embedding"):
+        batch_embeddings_raw = result.embedding
+    elif hasattr(result, "embeddings"):
+        batch_embeddings_raw = result.embeddings
+    elif isinstance(result, list):
+        batch_embeddings_raw = result
+    else:
+        raise RuntimeError(f"Unexpected embedding response format: {type(result)}")
+    
+    if batch_embeddings_raw is None:
+        raise RuntimeError("Could not extract embeddings from response")
+    
+    # Single vectorized float cast instead of a per-element Python loop
+    arr = np.asarray(batch_embeddings_raw, dtype=np.float32)
+    if arr.ndim != 2 or arr.shape[0] != len(batch) or arr.shape[1] == 0:
+        raise RuntimeError(f"Unexpected embedding shape {arr.shape} for batch of {len(batch)}")
+    return arr
+
+
+def _embed_batch(model: str, batch: list[str]) -> np.ndarray:
+    """
+    Embed one batch via the SDK's batch endpoint (a list `content` is sent as a
+    single BatchEmbedContents request). Returns a float32 array, one row per input.
+    """
+    genai = configure_genai()
+    result = genai.embed_content(
+        model=model,
+        content=batch,
+        task_type="retrieval_document",
+    )
+    return _embedding_matrix(result, batch)
+
+
+async def _aembed_batch(model: str, batch: list[str]) -> np.ndarray:
+    """
+    Async variant of _embed_batch.
+    """
+    genai = configure_genai()
+    result = await genai.embed_content_async(
+        model=model,
+        content=batch,
+        task_type="retrieval_document",
+    )
+    return _embedding_matrix(result, batch)
+
+
+def _dedup_texts(texts: list[str]) -> tuple[list[str], bool]:
+    """
+    Returns (texts_to_embed, deduplicated). Boilerplate (headers/footers) repeats
+    across pages: embed each distinct text once unless there is little to gain.
+    """
+    unique = list(dict.fromkeys(texts))
+    if len(unique) < 0.9 * len(texts):
+        return unique, True
+    return texts, False
+
+
+def _assemble_embeddings(
+    texts: list[str],
+    to_embed: list[str],
+    deduplicated: bool,
+    batch_size: int,
+    batch_results: list[np.ndarray | None],
+) -> np.ndarray:
+    """
+    Stitch per-batch results (None for a failed batch) back into one row per
+    input text, dropping rows whose batch failed.
+    """
+    succeeded = [(i * batch_size, result) for i, result in enumerate(batch_results) if result is not None]
+    if not succeeded:
+        raise RuntimeError("Failed to extract any embeddings from the API response")
+    
+    # One row per to_embed entry; `ok` marks rows whose batch succeeded
+    matrix = np.empty((len(to_embed), succeeded[0][1].shape[1]), dtype=np.float32)
+    ok = np.zeros(len(to_embed), dtype=bool)
+    for start, result in succeeded:
+        matrix[start:start + len(result)] = result
+        ok[start:start + len(result)] = True
+    
+    if deduplicated:
+        position = {t: i for i, t in enumerate(to_embed)}
+        index = np.fromiter((position[t] for t in texts), dtype=np.intp, count=len(texts))
+        matrix, ok = matrix[index], ok[index]
+    
+    embeddings = matrix if ok.all() else matrix[ok]
+    
+    if len(embeddings) != len(texts):
+        logger.warning(
+            f"Embedding count mismatch: expected {len(texts)}, got {len(embeddings)}. "
+            f"Some embeddings may have failed."
+        )
+    
+    return embeddings
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces embedding requests from concurrent embed_texts callers (chat
+    query embeddings, cache lookups) into shared BatchEmbedContents calls.
+
+    Callers block in embed() until their slice of a combined call is ready. A
+    background thread dispatches each request as soon as one of max_workers
+    calls is free, packing in whatever else is queued by then (up to
+    EMBED_BATCH_SIZE texts). An idle batcher never waits for company; requests
+    only share a call when they arrive while every worker is busy.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        max_batch: int = EMBED_BATCH_SIZE,
+        max_workers: int = EMBED_MAX_WORKERS,
+    ) -> None:
+        self.model = model
+        self.max_batch = max_batch
+        self._queue: queue.Queue[tuple[list[str], Future]] = queue.Queue()
+        self._free_workers = threading.Semaphore(max_workers)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embed")
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """
+        Embed up to max_batch texts, sharing the API call with other callers.
+        Raises whatever the underlying batch call raised.
+        """
+        if len(texts) > self.max_batch:
+            raise ValueError(f"At most {self.max_batch} texts per request, got {len(texts)}")
+        future: Future = Future()
+        self._queue.put((texts, future))
+        return future.result()
+
+    def _run(self) -> None:
+        carry: tuple[list[str], Future] | None = None
+        while True:
+            first = carry if carry is not None else self._queue.get()
+            carry = None
+            # Requests queued while waiting for a free worker join this call
+            self._free_workers.acquire()
+            pending = [first]
+            size = len(first[0])
+            while size < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if size + len(item[0]) > self.max_batch:
+                    carry = item  # starts the next combined call
+                    break
+                pending.append(item)
+                size += len(item[0])
+            self._pool.submit(self._dispatch, pending)
+
+    def _dispatch(self, pending: list[tuple[list[str], Future]]) -> None:
+        combined = [text for texts, _ in pending for text in texts]
+        try:
+            vectors = _embed_batch(self.model, combined)
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        finally:
+            self._free_workers.release()
+        offset = 0
+        for texts, future in pending:
+            future.set_result(vectors[offset:offset + len(texts)])
+            offset += len(texts)
+
+
+@cache
+def get_embedding_batcher() -> EmbeddingBatcher:
+    """
+    Process-wide batcher for the configured embedding model, started on first use.
+    """
+    return EmbeddingBatcher(settings.GEMINI_EMBEDDING_MODEL)
+
+
+def embed_texts(texts: list[str]) -> np.ndarray:
     """
     Use Gemini embedding model to convert a list of texts into embedding vectors.
-    Returns a list of vectors (one per text).
+    Returns a float32 array of shape (len(texts), dim), one row per text. Rows for
+    texts whose batch failed are dropped (a warning is logged).
     """
     if not texts:
-        return []
+        return np.empty((0, 0), dtype=np.float32)
     
     try:
-        model = settings.GEMINI_EMBEDDING_MODEL
-        embeddings: list[list[float]] = []
+        batcher = get_embedding_batcher()
+        to_embed, deduplicated = _dedup_texts(texts)
         
-        # Process in batches
-        batch_size = 100
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            
+        batch_size = EMBED_BATCH_SIZE
+        batches = [to_embed[i:i + batch_size] for i in range(0, len(to_embed), batch_size)]
+        
+        def run(batch_idx: int) -> np.ndarray | None:
             try:
-                # Call the embedding API
-                result = genai.embed_content(
-                    model=model,
-                    content=batch,
-                    task_type="retrieval_document",
-                )
-                
-                # The Google Generative AI SDK returns a dict with key 'embedding' (singular)
-                # The value is a list of embedding vectors: [[vec1], [vec2], ...]
-                # Each vector is a flat list of floats
-                
-                batch_embeddings_raw = None
-                
-                # Extract embeddings from the response
-                if isinstance(result, dict):
-                    if 'embedding' in result:
-                        # This is the correct format: {'embedding': [[...], [...], ...]}
-                        batch_embeddings_raw = result['embedding']
-                    elif 'embeddings' in result:
-                        # Fallback for other formats
-                        batch_embeddings_raw = result['embeddings']
-                elif hasattr(result, 'embedding'):
-                    batch_embeddings_raw = result.embedding
-                elif hasattr(result, 'embeddings'):
-                    batch_embeddings_raw = result.embeddings
-                elif isinstance(result, list):
-                    batch_embeddings_raw = result
-                else:
-                    logger.error(f"Unexpected embedding response format. Type: {type(result)}")
-                    raise RuntimeError(f"Unexpected embedding response format: {type(result)}")
-                
-                if batch_embeddings_raw is None:
-                    raise RuntimeError("Could not extract embeddings from response")
-                
-                # Process each embedding in the batch
-                # batch_embeddings_raw should be a list of lists: [[float, ...], [float, ...], ...]
-                if not isinstance(batch_embeddings_raw, list):
-                    raise RuntimeError(f"Expected list of embeddings, got {type(batch_embeddings_raw)}")
-                
-                for emb_idx, emb in enumerate(batch_embeddings_raw):
-                    try:
-                        # Each emb should be a list of floats
-                        if isinstance(emb, list):
-                            # Convert all elements to float
-                            emb_vector = [float(x) for x in emb]
-                            if emb_vector:
-                                embeddings.append(emb_vector)
-                            else:
-                                logger.warning(f"Empty embedding vector for batch item {emb_idx}")
-                        else:
-                            logger.warning(f"Unexpected embedding type at index {emb_idx}: {type(emb)}")
-                            continue
-                            
-                    except (ValueError, TypeError) as e:
-                        logger.warning(f"Error converting embedding {emb_idx} to floats: {e}")
-                        continue
-                    except Exception as e:
-                        logger.warning(f"Error processing embedding {emb_idx}: {e}")
-                        continue
-                
+                return batcher.embed(batches[batch_idx])
             except Exception as e:
-                logger.error(f"Error embedding batch starting at index {i}: {e}")
-                # Continue with next batch instead of failing completely
-                continue
+                logger.error(f"Error embedding batch starting at index {batch_idx * batch_size}: {e}")
+                # Continue with other batches instead of failing completely
+                return None
         
-        if len(embeddings) != len(texts):
-            logger.warning(
-                f"Embedding count mismatch: expected {len(texts)}, got {len(embeddings)}. "
-                f"Some embeddings may have failed."
-            )
+        # Batches are independent I/O calls; issue them concurrently, keep order.
+        # Partial batches may be coalesced with other callers' texts by the batcher.
+        if len(batches) == 1:
+            batch_results = [run(0)]
+        else:
+            with ThreadPoolExecutor(max_workers=EMBED_MAX_WORKERS) as pool:
+                batch_results = list(pool.map(run, range(len(batches))))
+        
+        return _assemble_embeddings(texts, to_embed, deduplicated, batch_size, batch_results)
         
-        if not embeddings:
-            raise RuntimeError("Failed to extract any embeddings from the API response")
+    except Exception as e:
+        logger.exception(f"Embedding failed: {e}")
+        raise RuntimeError(f"Failed to embed texts: {e}") from e
+
+
+async def aembed_texts(
+    texts: list[str],
+    batch_size: int = EMBED_BATCH_SIZE,
+    max_concurrency: int = 8,
+    retries: int = 2,
+) -> np.ndarray:
+    """
+    Async variant of embed_texts for large inputs (e.g. a document's chunks).
+    Batches are sent concurrently, at most max_concurrency in flight, each retried
+    with exponential backoff before being dropped. Same return contract as embed_texts.
+    """
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    
+    try:
+        model = settings.GEMINI_EMBEDDING_MODEL
+        to_embed, deduplicated = _dedup_texts(texts)
+        batches = [to_embed[i:i + batch_size] for i in range(0, len(to_embed), batch_size)]
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def embed_one(batch_idx: int) -> np.ndarray | None:
+            async with semaphore:
+                for attempt in range(retries + 1):
+                    try:
+                        return await _aembed_batch(model, batches[batch_idx])
+                    except Exception as e:
+                        if attempt == retries:
+                            logger.error(f"Error embedding batch starting at index {batch_idx * batch_size}: {e}")
+                            return None
+                        await asyncio.sleep(0.5 * 2 ** attempt)
         
-        return embeddings
+        batch_results = await asyncio.gather(*(embed_one(i) for i in range(len(batches))))
+        return _assemble_embeddings(texts, to_embed, deduplicated, batch_size, list(batch_results))
         
     except Exception as e:
         logger.exception(f"Embedding failed: {e}")
-        raise RuntimeError(f"Failed to embed texts: {e}") from e
\ No newline at end of file
+        raise RuntimeError(f"Failed to embed texts: {e}") from e
@@ -0,0 +1,191 @@
+"""
+Disk-backed response cache for LLM calls and embeddings.
+
+Exact hits are keyed by sha256(system_prompt + user_prompt). On a miss, an
+optional question key (e.g. the raw user question) is looked up with case,
+whitespace and punctuation normalized away, reusing a past response from the
+same scope. Only the same words match: similar questions can want different
+answers (a bar chart instead of a line chart), so there is no fuzzy matching.
+
+Embeddings are cached per text, keyed by sha256(embedding model + text), so
+re-parsing a PDF or near-duplicate reports only embeds the chunks not seen before.
+"""
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from typing import Any, Awaitable, Callable
+
+import numpy as np
+from diskcache import Cache
+
+from app.config import settings
+from app.llm import acall_llm, aembed_texts, call_llm, embed_texts
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\w+")
+
+_cache = Cache(settings.LLM_CACHE_DIR)
+
+
+def _hash(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def _normalize_question(text: str) -> str:
+    # Case, whitespace and punctuation don't change what is being asked
+    return " ".join(_WORD_RE.findall(text.lower()))
+
+
+def _question_cache_key(system_prompt: str, question_key: str, question_scope: str) -> tuple[str, str]:
+    return ("question", _hash(system_prompt, question_scope, _normalize_question(question_key)))
+
+
+def _lookup(
+    system_prompt: str,
+    user_prompt: str,
+    question_key: str | None,
+    question_scope: str,
+) -> str | None:
+    hit = _cache.get(("exact", _hash(system_prompt, user_prompt)))
+    if hit is None and question_key:
+        hit = _cache.get(_question_cache_key(system_prompt, question_key, question_scope))
+        if hit is not None:
+            logger.info("LLM cache hit on normalized question")
+    return hit["response"] if hit is not None else None
+
+
+def _store(
+    system_prompt: str,
+    user_prompt: str,
+    question_key: str | None,
+    question_scope: str,
+    response: str,
+) -> None:
+    if response.startswith("LLM error:"):
+        # Never cache failures
+        return
+
+    entry = {"response": response, "ts": time.time()}
+    with _cache.transact():
+        _cache.set(("exact", _hash(system_prompt, user_prompt)), entry)
+        if question_key:
+            _cache.set(_question_cache_key(system_prompt, question_key, question_scope), entry)
+
+
+def cached_call_llm(
+    system_prompt: str,
+    user_prompt: str,
+    question_key: str | None = None,
+    question_scope: str = "",
+    llm_fn: Callable[[str, str], str] = call_llm,
+    parse: Callable[[str], Any] | None = None,
+) -> Any:
+    """
+    Drop-in replacement for call_llm with response caching.
+
+    question_key: short text matched, once normalized, against past keys
+      (None disables the lookup).
+    question_scope: extra context that must match exactly for a question hit,
+      e.g. the metrics summary the prompt was built from.
+    llm_fn: function used on a cache miss (defaults to call_llm).
+    parse: turns a response into the value returned instead of its text, or None
+      if it is unusable. Only responses that parse are cached, and a cached one
+      that doesn't is asked for again; without parse, any non-error response is.
+    """
+    cached = _lookup(system_prompt, user_prompt, question_key, question_scope)
+    if cached is not None:
+        parsed = parse(cached) if parse is not None else cached
+        if parsed is not None:
+            return parsed
+    response = llm_fn(system_prompt, user_prompt)
+    parsed = parse(response) if parse is not None else response
+    if parsed is not None:
+        _store(system_prompt, user_prompt, question_key, question_scope, response)
+    return parsed
+
+
+async def acached_call_llm(
+    system_prompt: str,
+    user_prompt: str,
+    question_key: str | None = None,
+    question_scope: str = "",
+    llm_fn: Callable[[str, str], Awaitable[str]] = acall_llm,
+    parse: Callable[[str], Any] | None = None,
+) -> Any:
+    """
+    Async variant of cached_call_llm. Cache I/O runs in a worker thread.
+    """
+    cached = await asyncio.to_thread(
+        _lookup, system_prompt, user_prompt, question_key, question_scope
+    )
+    if cached is not None:
+        parsed = parse(cached) if parse is not None else cached
+        if parsed is not None:
+            return parsed
+    response = await llm_fn(system_prompt, user_prompt)
+    parsed = parse(response) if parse is not None else response
+    if parsed is not None:
+        await asyncio.to_thread(_store, system_prompt, user_prompt, question_key, question_scope, response)
+    return parsed
+
+
+def _embedding_key(text: str) -> tuple[str, str]:
+    return ("embed", _hash(settings.GEMINI_EMBEDDING_MODEL, text))
+
+
+def _lookup_embeddings(texts: list[str]) -> tuple[list[np.ndarray | None], list[str]]:
+    """
+    Return (per-text cached vector or None, unique texts still to embed).
+    """
+    cached = [_cache.get(_embedding_key(text)) for text in texts]
+    misses = list(dict.fromkeys(text for text, vec in zip(texts, cached) if vec is None))
+    return cached, misses
+
+
+def _store_embeddings(
+    texts: list[str],
+    cached: list[np.ndarray | None],
+    misses: list[str],
+    fresh: np.ndarray,
+) -> np.ndarray:
+    """
+    Cache freshly embedded misses and assemble the full matrix in input order.
+    """
+    if len(fresh) != len(misses):
+        # The embedder dropped failed rows, so fresh vectors can't be matched to texts
+        raise RuntimeError(f"Failed to embed texts: got {len(fresh)} of {len(misses)} embeddings")
+    by_text = dict(zip(misses, fresh))
+    with _cache.transact():
+        for text, vec in by_text.items():
+            _cache.set(_embedding_key(text), vec)
+    return np.stack([vec if vec is not None else by_text[text] for text, vec in zip(texts, cached)])
+
+
+def cached_embed_texts(texts: list[str]) -> np.ndarray:
+    """
+    Drop-in replacement for embed_texts that reuses cached vectors per text.
+    Unlike embed_texts, a partially failed batch raises instead of dropping rows.
+    """
+    if not texts:
+        return embed_texts(texts)
+    cached, misses = _lookup_embeddings(texts)
+    fresh = embed_texts(misses) if misses else np.empty((0, 0), dtype=np.float32)
+    return _store_embeddings(texts, cached, misses, fresh)
+
+
+async def acached_embed_texts(texts: list[str]) -> np.ndarray:
+    """
+    Async variant of cached_embed_texts. Cache I/O runs in a worker thread.
+    """
+    if not texts:
+        return await aembed_texts(texts)
+    cached, misses = await asyncio.to_thread(_lookup_embeddings, texts)
+    fresh = await aembed_texts(misses) if misses else np.empty((0, 0), dtype=np.float32)
+    return await asyncio.to_thread(_store_embeddings, texts, cached, misses, fresh)
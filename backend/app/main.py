@@ -1,13 +1,39 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import anyio.to_thread
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from app.config import settings
 from app.database import Base, engine
+from app.parsing import shutdown_extract_pool
 from app.routers import chat, upload, documents
+from app.routers.upload import fail_interrupted_parses
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Size both thread pools: anyio's (sync endpoints/dependencies) and the
+    # loop's default executor (asyncio.to_thread offloads)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.THREAD_POOL_SIZE
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=settings.THREAD_POOL_SIZE)
+    )
+    # Create tables (models are registered on Base by the router imports)
+    Base.metadata.create_all(bind=engine)
+    interrupted = fail_interrupted_parses()
+    if interrupted:
+        logger.warning("Marked %d documents interrupted mid-parse as failed", interrupted)
+    yield
+    shutdown_extract_pool()
 
-# Create tables
-Base.metadata.create_all(bind=engine)
 
-app = FastAPI(title="BalanceSheet Chat Backend")
+app = FastAPI(title="BalanceSheet Chat Backend", lifespan=lifespan)
 
 
 # CORS (allow all during dev – tighten for prod)
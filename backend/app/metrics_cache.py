@@ -0,0 +1,52 @@
+"""
+In-process cache of per-document metric reads for the chat path.
+
+A parsed document's metrics don't change, so repeat chat turns on the same
+document can skip the metrics query, and overview answers built from them can
+be reused as they are. Entries are keyed by a tuple whose first
+element is the document id, bounded in count (least recently used evicted
+first) and expire after a TTL, which also bounds staleness across worker
+processes. parse_pdf_and_populate_metrics invalidates a document after a
+(re-)parse. Cached values are shared: callers must not mutate them.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Tuple
+
+METRICS_CACHE_SIZE = 1024
+METRICS_CACHE_TTL_SECONDS = 300
+
+# key -> (expires_at, value), least recently used first
+_entries: "OrderedDict[Tuple[Hashable, ...], Tuple[float, Any]]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def get(key: Tuple[Hashable, ...]) -> Any | None:
+    """
+    Return the cached value for key (key[0] is the document id), or None if it
+    is missing or expired.
+    """
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        _entries.move_to_end(key)
+        return entry[1]
+
+
+def put(key: Tuple[Hashable, ...], value: Any) -> None:
+    with _lock:
+        _entries[key] = (time.monotonic() + METRICS_CACHE_TTL_SECONDS, value)
+        _entries.move_to_end(key)
+        while len(_entries) > METRICS_CACHE_SIZE:
+            _entries.popitem(last=False)
+
+
+def invalidate(document_id: int) -> None:
+    """
+    Drop every cached entry of a document.
+    """
+    with _lock:
+        for key in [key for key in _entries if key[0] == document_id]:
+            del _entries[key]
@@ -1,9 +1,44 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Boolean, Text, DateTime, JSON
+import numpy as np
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Boolean, Text, DateTime, LargeBinary, Index
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
+from sqlalchemy.types import TypeDecorator
+from app import jsonutil
 from app.database import Base
 
 
+def pack_embedding(vec) -> bytes:
+    """Serialize an embedding vector as compact float16 bytes."""
+    return np.asarray(vec, dtype=np.float16).tobytes()
+
+
+def unpack_embedding(data: bytes) -> np.ndarray:
+    """Deserialize float16 bytes back into a float32 vector."""
+    return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+
+
+class EmbeddingVector(TypeDecorator):
+    """
+    Stores an embedding as a float16 BLOB (768 dims -> 1536 bytes) instead of a JSON array.
+    Reads return a float32 numpy array. Legacy JSON-encoded rows are still decoded.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return pack_embedding(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            # Rows written before the switch from the JSON column
+            return np.asarray(jsonutil.loads(value), dtype=np.float32)
+        return unpack_embedding(value)
+
+
 class Company(Base):
     __tablename__ = "companies"
 
@@ -25,21 +60,35 @@ class Document(Base):
     fiscal_year = Column(String, nullable=True)  # e.g. "FY 2023-24"
     company_code = Column(String, nullable=True)  # optional, for grouping/legacy
     is_financial_report = Column(Boolean, default=True)
-    classification_reason = Column(Text, nullable=True)  # Explanation for classification decision
+    # Explanation for classification decision; free text, so loaded only when accessed
+    classification_reason = deferred(Column(Text, nullable=True))
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     processed_at = Column(DateTime(timezone=True), nullable=True)
+    # "pending" until background classification and parsing finish, then "done",
+    # "failed", or "rejected" (not a financial document)
+    parse_status = Column(String, nullable=True, default="pending")
 
     metrics = relationship("FinancialMetric", back_populates="document")
 
 
 class FinancialMetric(Base):
     __tablename__ = "financial_metrics"
+    # Only the indexes the queries need, since every bulk metric insert updates each one
+    __table_args__ = (
+        # Serves "metric_name IN (...) ordered by year" per document (the chat metric
+        # fetch) without a sort, and the documents list's per-document lookups
+        Index("ix_fm_doc_metric_year", "document_id", "metric_name", "year"),
+        # One value per company, year and metric (seed_data upserts against it), also
+        # used for the company metric fetch; document metrics have a NULL company_id,
+        # which never conflicts
+        Index("ux_fm_co_year_metric", "company_id", "year", "metric_name", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     company_id = Column(Integer, ForeignKey("companies.id"), nullable=True)  # nullable for document-based metrics
     document_id = Column(Integer, ForeignKey("documents.id"), nullable=True)  # nullable for legacy company-based metrics
-    year = Column(Integer, index=True)
-    metric_name = Column(String, index=True)  # e.g. "revenue", "net_profit", "total_assets", "total_liabilities"
+    year = Column(Integer)
+    metric_name = Column(String)  # e.g. "revenue", "net_profit", "total_assets", "total_liabilities"
     value = Column(Float)
     unit = Column(String, default="INR Cr")
 
@@ -54,7 +103,29 @@ class DocumentChunk(Base):
     document_id = Column(Integer, ForeignKey("documents.id"), nullable=False)
     page_number = Column(Integer, nullable=True)   # 1-based page index
     chunk_index = Column(Integer, nullable=False)  # position within document
-    text = Column(Text, nullable=False)
-    embedding = Column(JSON, nullable=True)  # Store embedding vector as JSON array
+    # The bulky columns load only when accessed; retrieval selects them explicitly
+    text = deferred(Column(Text, nullable=False))
+    embedding = deferred(Column(EmbeddingVector, nullable=True))  # float16 BLOB, read back as np.ndarray
+    # Retrieval keyword flags, computed once at ingest (NULL for chunks stored before them)
+    has_mda = Column(Boolean, nullable=True)
+    has_financial = Column(Boolean, nullable=True)
+    has_auditor = Column(Boolean, nullable=True)
 
     document = relationship("Document", backref="chunks")
+
+
+class DocumentEmbeddings(Base):
+    """
+    A document's whole similarity index in one row (see app.vector_store): the
+    chunks' quantized, L2-normalized embedding matrix and its parallel arrays,
+    each stored as contiguous little-endian bytes.
+    """
+    __tablename__ = "document_embeddings"
+
+    document_id = Column(Integer, ForeignKey("documents.id"), primary_key=True)
+    dim = Column(Integer, nullable=False)
+    dtype = Column(String, nullable=False)            # dtype of matrix, e.g. "uint8"
+    chunk_ids = Column(LargeBinary, nullable=False)   # int64 [N], row order of matrix
+    matrix = Column(LargeBinary, nullable=False)      # [N, dim]
+    params = Column(LargeBinary, nullable=False)      # float32 [2, dim] dequantization offset, scale
+    flags = Column(LargeBinary, nullable=False)       # uint8 [N] keyword flag bitmasks
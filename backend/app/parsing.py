@@ -1,46 +1,191 @@
-import json
+import asyncio
 import logging
+import multiprocessing
+import os
 import re
-from typing import List, Dict, Any, Tuple
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import cache, partial
+from itertools import islice, repeat
+from typing import List, Dict, Any, Iterable, Iterator, Tuple
 from datetime import datetime
 
-import pdfplumber
+import numpy as np
+import pypdfium2 as pdfium
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
-from app.llm import call_llm, embed_texts
+from app import jsonutil, metrics_cache, vector_store
+from app.config import settings
+from app.llm import JsonObjectScanner, acall_llm
+from app.llm_cache import acached_call_llm, acached_embed_texts, cached_call_llm
 from app.models import Document, FinancialMetric, DocumentChunk
+from app.retrieval import chunk_keyword_flags
+from app.schemas import FinancialsExtraction
 
 
 
 
 logger = logging.getLogger(__name__)
 
+# Chunks per embedding request / insert, and how many requests may be in flight
+CHUNK_BATCH_SIZE = 100
+CHUNK_PIPELINE_DEPTH = 4
 
-def chunk_text(text: str, max_chars: int = 1200, overlap: int = 200) -> list[str]:
+# Constrain the combined extraction to the FinancialsExtraction JSON shape
+FINANCIALS_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": FinancialsExtraction,
+}
+
+
+async def _acall_financials_llm(system_prompt: str, user_prompt: str) -> str:
+    return await acall_llm(system_prompt, user_prompt, FINANCIALS_GENERATION_CONFIG)
+
+
+# Prompt budgets, in approximate tokens (see clip_to_tokens)
+CHARS_PER_TOKEN = 4
+META_MAX_TOKENS = 3000
+STATEMENT_MAX_TOKENS = 6000
+CLASSIFY_MAX_TOKENS = 1250
+
+# Below this many pages, process start-up and pickling cost more than they save
+PARALLEL_EXTRACT_MIN_PAGES = 10
+
+# Extraction worker processes are replaced after this many tasks, so memory
+# PDFium keeps hold of is returned to the OS instead of growing with each upload
+EXTRACT_WORKER_MAX_TASKS = 20
+
+# PDFium is not thread-safe; serialize all access within the process
+_PDFIUM_LOCK = threading.Lock()
+
+
+@contextmanager
+def open_pdf(pdf_path: str) -> Iterator[pdfium.PdfDocument]:
+    """
+    Open a PDF with PDFium (C++), holding the process-wide PDFium lock until closed.
+    Pages are indexed with pdf[i]; len(pdf) is the page count.
+    """
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            yield pdf
+        finally:
+            pdf.close()
+
+
+def extract_page_text(page: pdfium.PdfPage) -> str:
+    """
+    Extract a page's text in reading order, with "\n" line endings.
+    """
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_range().replace("\r\n", "\n")
+    finally:
+        textpage.close()
+        page.close()
+
+
+def _strip_bounds(text: str, start: int, end: int) -> Tuple[int, int]:
+    """
+    Narrow [start, end) past leading/trailing whitespace without copying text.
+    """
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def _extract_page_text_safe(pdf: pdfium.PdfDocument, index: int) -> str:
+    """
+    extract_page_text for pdf[index], returning "" if that page fails (e.g. a
+    corrupt content stream) so one bad page doesn't abort the whole document.
+    """
+    try:
+        return extract_page_text(pdf[index])
+    except Exception as e:
+        logger.warning("Skipping unreadable page %d: %s", index + 1, e)
+        return ""
+
+
+def chunk_text(text: str, max_chars: int = 1200, overlap: int = 200) -> Iterator[str]:
     """
     Simple character-based chunking with overlap. This is enough for RAG usage in this project.
+    Yields chunks lazily. Boundaries are computed with offset arithmetic on the
+    original string, so each chunk is sliced exactly once.
     max_chars: maximum length of each chunk.
     overlap: number of characters of overlap between consecutive chunks.
     """
-    text = text.strip()
-    if not text:
-        return []
+    # Equivalent to chunking text.strip(), without the copy
+    offset, stop = _strip_bounds(text, 0, len(text))
+    length = stop - offset
     
-    chunks: list[str] = []
     start = 0
-    length = len(text)
     
     while start < length:
         end = min(start + max_chars, length)
-        chunk = text[start:end].strip()
-        if chunk:
-            chunks.append(chunk)
+        s, e = _strip_bounds(text, offset + start, offset + end)
+        if s < e:
+            yield text[s:e]
         if end >= length:
             break
         # Overlap
         start = max(0, end - overlap)
-    
-    return chunks
+
+
+def iter_chunks(page_texts: Iterable[str]) -> Iterator[Tuple[int, int, str]]:
+    """
+    Yield (page_number, chunk_index, text) for every chunk, one page at a time.
+    Page numbers are 1-based.
+    """
+    for page_idx, text in enumerate(page_texts):
+        for ci, ch in enumerate(chunk_text(text)):
+            yield page_idx + 1, ci, ch
+
+
+def _batched(items: Iterable[Any], size: int) -> Iterator[list[Any]]:
+    it = iter(items)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+def clip_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Clip text to roughly max_tokens, estimated at CHARS_PER_TOKEN characters per
+    token (close enough for Gemini on English financial text). Cuts at the last
+    whitespace before the limit so words aren't split.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    window_start = max(0, max_chars - 200)
+    cut = max(text.rfind(" ", window_start, max_chars), text.rfind("\n", window_start, max_chars))
+    return text[:cut if cut > 0 else max_chars]
+
+
+def find_balanced_json(text: str, start: int = 0) -> Tuple[int, int] | None:
+    """
+    Locate the first balanced {...} object at or after `start` in one linear pass
+    (braces inside JSON strings are ignored). Returns (begin, end) offsets or None.
+    """
+    begin = text.find("{", start)
+    if begin < 0:
+        return None
+    end = JsonObjectScanner().feed(text[begin:])
+    if end is None:
+        return None
+    return begin, begin + end
+
+
+def _extract_json_object(raw: str, context: str) -> Dict[str, Any] | None:
+    """
+    _extract_json, but None unless the parsed JSON is an object.
+    """
+    parsed = _extract_json(raw, context)
+    return parsed if isinstance(parsed, dict) else None
 
 
 def _extract_json(raw: str, context: str) -> Any | None:
@@ -51,65 +196,244 @@ def _extract_json(raw: str, context: str) -> Any | None:
     raw = raw.strip()
     # Try direct parse
     try:
-        return json.loads(raw)
+        return jsonutil.loads(raw)
     except Exception:
         pass
 
-    # Try to find a JSON object substring
-    m = re.search(r"\{.*\}", raw, re.DOTALL)
-    if m:
-        candidate = m.group(0)
+    # Try each top-level JSON object substring in turn
+    span = find_balanced_json(raw)
+    while span is not None:
+        begin, end = span
         try:
-            return json.loads(candidate)
+            return jsonutil.loads(raw[begin:end])
         except Exception:
             logger.exception("Failed to parse JSON candidate for %s", context)
+        span = find_balanced_json(raw, end)
 
     logger.error("Could not parse JSON for %s. Raw response: %r", context, raw[:500])
     return None
 
 
-def _find_pages_with_keywords(pdf: pdfplumber.PDF, keywords: List[str]) -> List[int]:
-    indices: List[int] = []
-    for i, page in enumerate(pdf.pages):
-        text = page.extract_text() or ""
-        lower = text.lower()
-        if any(kw.lower() in lower for kw in keywords):
-            indices.append(i)
-    return indices
+def _extract_workers() -> int:
+    return settings.PDF_EXTRACT_PROCESSES or os.cpu_count() or 1
+
+
+@cache
+def _get_extract_pool() -> ProcessPoolExecutor:
+    # spawn, not fork: a forked child could inherit _PDFIUM_LOCK held by another thread
+    return ProcessPoolExecutor(
+        max_workers=_extract_workers(),
+        mp_context=multiprocessing.get_context("spawn"),
+        max_tasks_per_child=EXTRACT_WORKER_MAX_TASKS,
+    )
+
+
+def shutdown_extract_pool() -> None:
+    """
+    Stop the extraction worker processes, if any were started.
+    """
+    if _get_extract_pool.cache_info().currsize:
+        _get_extract_pool().shutdown(wait=False, cancel_futures=True)
+        _get_extract_pool.cache_clear()
 
 
-def classify_pdf_as_financial(pdf_path: str) -> Tuple[bool, str]:
+def _extract_page_range(pdf_path: str, start: int, stop: int) -> list[str]:
     """
-    Classify a PDF as financial (balance sheet/annual report) or non-financial.
-    Returns (is_financial: bool, reason: str)
+    Extract pages [start, stop) in a worker process. Each process has its own
+    PDFium instance, so _PDFIUM_LOCK is not needed here.
+    """
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return [_extract_page_text_safe(pdf, i) for i in range(start, stop)]
+    finally:
+        pdf.close()
+
+
+def _extract_leading_pages(pdf_path: str, max_pages: int) -> Tuple[int, list[str]]:
+    """
+    Page count and the text of the first max_pages pages, in a worker process.
+    """
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        n_pages = len(pdf)
+        return n_pages, [_extract_page_text_safe(pdf, i) for i in range(min(max_pages, n_pages))]
+    finally:
+        pdf.close()
+
+
+def extract_leading_pages(pdf_path: str, max_pages: int) -> Tuple[int, list[str]]:
+    """
+    Page count and the text of the first max_pages pages. Extracted in the
+    process pool when there is one, so concurrent uploads don't queue on
+    _PDFIUM_LOCK.
+    """
+    if _extract_workers() <= 1:
+        with open_pdf(pdf_path) as pdf:
+            n_pages = len(pdf)
+            return n_pages, [_extract_page_text_safe(pdf, i) for i in range(min(max_pages, n_pages))]
+    return _get_extract_pool().submit(_extract_leading_pages, pdf_path, max_pages).result()
+
+
+def extract_page_texts(pdf_path: str) -> list[str]:
+    """
+    Open the PDF once and extract every page's text, indexed by page (0-based).
+    PDFs over PARALLEL_EXTRACT_MIN_PAGES pages are split into contiguous page
+    ranges extracted in a process pool.
+    """
+    workers = _extract_workers()
+    with open_pdf(pdf_path) as pdf:
+        n_pages = len(pdf)
+        if n_pages <= PARALLEL_EXTRACT_MIN_PAGES or workers <= 1:
+            return [_extract_page_text_safe(pdf, i) for i in range(n_pages)]
+
+    step = -(-n_pages // workers)
+    starts = range(0, n_pages, step)
+    stops = [min(start + step, n_pages) for start in starts]
+    page_texts: list[str] = []
+    for texts in _get_extract_pool().map(_extract_page_range, repeat(pdf_path), starts, stops):
+        page_texts.extend(texts)
+    return page_texts
+
+
+# Statement headings, scanned for in a single pass over each page
+PNL_KEYWORDS = ["statement of profit and loss", "profit and loss", "statement of profit"]
+BS_KEYWORDS = ["balance sheet", "statement of financial position"]
+
+# Line items that make up each statement; their density ranks candidate pages
+PNL_LINE_ITEMS = [
+    "revenue from operations", "total income", "total expenses", "finance costs",
+    "profit before tax", "tax expense", "profit for the year", "earnings per share",
+]
+BS_LINE_ITEMS = [
+    "non-current assets", "current assets", "total assets", "equity share capital",
+    "other equity", "non-current liabilities", "current liabilities", "total equity and liabilities",
+]
+
+# Statements span a few contiguous pages; later hits are notes and cross-references
+MAX_SECTION_PAGES = 3
+# Pages per section sent to the LLM, chosen by keyword density
+STATEMENT_TOP_K = 4
+
+
+def _alternation(group: str, keywords: List[str]) -> str:
+    return f"(?P<{group}>" + "|".join(re.escape(kw) for kw in sorted(keywords, key=len, reverse=True)) + ")"
+
+
+_SECTION_RE = re.compile(
+    "|".join([
+        _alternation("pnl", PNL_KEYWORDS),
+        _alternation("bs", BS_KEYWORDS),
+        _alternation("pnl_item", PNL_LINE_ITEMS),
+        _alternation("bs_item", BS_LINE_ITEMS),
+    ])
+)
+
+
+def _section_hits(text: str) -> Dict[str, int]:
+    """
+    Count heading and line-item keyword hits per group in one regex scan.
+    """
+    hits = {"pnl": 0, "bs": 0, "pnl_item": 0, "bs_item": 0}
+    if text and not text.isspace():
+        for m in _SECTION_RE.finditer(text.lower()):
+            hits[m.lastgroup] += 1
+    return hits
+
+
+def _classify_pages(page_texts: List[str]) -> Tuple[List[int], List[int]]:
+    """
+    Return (pnl_indices, bs_indices) in page order. Candidates are the first
+    MAX_SECTION_PAGES pages with a P&L / Balance Sheet heading plus the page after
+    each (the scan stops once both sections have them); of those, the
+    STATEMENT_TOP_K pages with the most heading + line-item hits are kept.
     """
+    hits: Dict[int, Dict[str, int]] = {}
+
+    def page_hits(i: int) -> Dict[str, int]:
+        if i not in hits:
+            hits[i] = _section_hits(page_texts[i])
+        return hits[i]
+
+    headed: Dict[str, List[int]] = {"pnl": [], "bs": []}
+    for i in range(len(page_texts)):
+        page = page_hits(i)
+        for section, indices in headed.items():
+            if page[section] and len(indices) < MAX_SECTION_PAGES:
+                indices.append(i)
+        if all(len(indices) >= MAX_SECTION_PAGES for indices in headed.values()):
+            break
+
+    def top_pages(section: str) -> List[int]:
+        def score(j: int) -> int:
+            return page_hits(j)[section] + page_hits(j)[f"{section}_item"]
+
+        candidates = {j for i in headed[section] for j in (i, i + 1) if j < len(page_texts)}
+        ranked = sorted(candidates, key=lambda j: (-score(j), j))[:STATEMENT_TOP_K]
+        return sorted(j for j in ranked if score(j) > 0)
+
+    return top_pages("pnl"), top_pages("bs")
+
+
+# Classifier pre-filter: documents mentioning this many distinct keywords, including
+# a statement heading, are accepted without an LLM call; documents longer than
+# CLASSIFY_REJECT_MIN_PAGES with none of them in the sample are rejected
+FINANCIAL_KEYWORDS = [
+    "balance sheet", "profit and loss", "financial statement",
+    "annual report", "revenue", "assets", "liabilities",
+    "cash flow", "statement of financial position",
+    "consolidated", "standalone"
+]
+STATEMENT_KEYWORDS = frozenset({"balance sheet", "profit and loss", "statement of financial position"})
+CLASSIFY_ACCEPT_KEYWORDS = 5
+CLASSIFY_REJECT_MIN_PAGES = 3
+
+# Reason prefix of a classification that failed rather than decided
+CLASSIFY_ERROR_PREFIX = "Error analyzing PDF: "
+
+# Classification results kept in memory, by file content hash
+CLASSIFY_CACHE_SIZE = 1024
+_classifications: "OrderedDict[str, Tuple[bool, str]]" = OrderedDict()
+_classifications_lock = threading.Lock()
+
+_FINANCIAL_KEYWORDS_RE = re.compile(
+    "|".join(re.escape(kw) for kw in sorted(FINANCIAL_KEYWORDS, key=len, reverse=True))
+)
+
+
+def _classify_pdf(pdf_path: str) -> Tuple[bool, str]:
     logger.info("Classifying PDF: %s", pdf_path)
     
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            pages = pdf.pages
-            # Extract text from first 5 pages for classification
-            # This is usually enough to determine document type
-            sample_text = "\n\n".join(
-                (pages[i].extract_text() or "") for i in range(min(5, len(pages)))
-            )
-            
-            # If PDF is very short or has no text, it's likely not a financial document
-            if len(sample_text.strip()) < 100:
-                return False, "PDF contains insufficient text content to be a financial document"
-            
-            classification_system = (
-                "You are a document classifier specializing in financial documents. "
-                "Your task is to determine if a PDF document is a financial report (balance sheet, annual report, "
-                "quarterly report, financial statements) or a non-financial document (novel, marksheet, "
-                "general document, etc.). Be strict: only classify as financial if the document clearly contains "
-                "financial statements, balance sheets, profit & loss statements, or annual/quarterly financial reports."
-            )
-            
-            classification_user = f"""
+        # Extract text from first 5 pages for classification
+        # This is usually enough to determine document type
+        n_pages, sample_pages = extract_leading_pages(pdf_path, 5)
+        sample_text = "\n\n".join(sample_pages)
+        
+        # If PDF is very short or has no text, it's likely not a financial document
+        if len(sample_text.strip()) < 100:
+            return False, "PDF contains insufficient text content to be a financial document"
+        
+        # Skip the LLM when the keywords are unambiguous either way
+        found_keywords = set(_FINANCIAL_KEYWORDS_RE.findall(sample_text.lower()))
+        if len(found_keywords) >= CLASSIFY_ACCEPT_KEYWORDS and found_keywords & STATEMENT_KEYWORDS:
+            logger.info("Classified %s as financial from keywords: %s", pdf_path, sorted(found_keywords))
+            return True, "Document contains financial statements (high-confidence keyword match)"
+        if not found_keywords and n_pages > CLASSIFY_REJECT_MIN_PAGES:
+            logger.info("Classified %s as non-financial: no financial keywords in first pages", pdf_path)
+            return False, "Document does not appear to be a financial report (no financial keywords found)"
+        
+        classification_system = (
+            "You are a document classifier specializing in financial documents. "
+            "Your task is to determine if a PDF document is a financial report (balance sheet, annual report, "
+            "quarterly report, financial statements) or a non-financial document (novel, marksheet, "
+            "general document, etc.). Be strict: only classify as financial if the document clearly contains "
+            "financial statements, balance sheets, profit & loss statements, or annual/quarterly financial reports."
+        )
+        
+        classification_user = f"""
 Analyze the following text extracted from the first pages of a PDF document:
 
-\"\"\"{sample_text[:5000]}\"\"\"
+\"\"\"{clip_to_tokens(sample_text, CLASSIFY_MAX_TOKENS)}\"\"\"
 
 Determine if this is a financial document (balance sheet, annual report, financial statements) or a non-financial document.
 
@@ -135,65 +459,230 @@ Examples of non-financial documents:
 
 Be strict: if the document does not clearly contain financial statements, balance sheets, or profit & loss data, classify it as non-financial.
 """
-            
-            classification_raw = call_llm(classification_system, classification_user)
-            classification = _extract_json(classification_raw, "PDF classification")
-            
-            if isinstance(classification, dict):
-                is_financial = classification.get("is_financial", False)
-                reason = classification.get("reason", "Classification completed")
-                logger.info(
-                    "Classification result for %s: is_financial=%s, reason=%s",
-                    pdf_path,
-                    is_financial,
-                    reason
-                )
-                return bool(is_financial), str(reason)
+        
+        # A reply that doesn't parse isn't cached, so the same PDF is asked about again
+        classification = cached_call_llm(
+            classification_system,
+            classification_user,
+            parse=partial(_extract_json_object, context="PDF classification"),
+        )
+        
+        if classification is not None:
+            is_financial = classification.get("is_financial", False)
+            reason = classification.get("reason", "Classification completed")
+            logger.info(
+                "Classification result for %s: is_financial=%s, reason=%s",
+                pdf_path,
+                is_financial,
+                reason
+            )
+            return bool(is_financial), str(reason)
+        else:
+            # Fallback: check for common financial keywords
+            if found_keywords:
+                return True, "Document contains financial keywords (fallback classification)"
             else:
-                # Fallback: check for common financial keywords
-                sample_lower = sample_text.lower()
-                financial_keywords = [
-                    "balance sheet", "profit and loss", "financial statement",
-                    "annual report", "revenue", "assets", "liabilities",
-                    "cash flow", "statement of financial position",
-                    "consolidated", "standalone"
-                ]
-                has_financial_keywords = any(keyword in sample_lower for keyword in financial_keywords)
+                return False, "Document does not appear to be a financial report (fallback classification)"
                 
-                if has_financial_keywords:
-                    return True, "Document contains financial keywords (fallback classification)"
-                else:
-                    return False, "Document does not appear to be a financial report (fallback classification)"
-                    
     except Exception as e:
         logger.exception("Error classifying PDF %s: %s", pdf_path, e)
         # On error, be conservative and reject
-        return False, f"Error analyzing PDF: {str(e)}"
+        return False, f"{CLASSIFY_ERROR_PREFIX}{str(e)}"
 
 
-def parse_pdf_and_populate_metrics(doc: Document, db: Session) -> None:
+def classify_pdf_as_financial(pdf_path: str, content_hash: str | None = None) -> Tuple[bool, str]:
+    """
+    Classify a PDF as financial (balance sheet/annual report) or non-financial.
+    Returns (is_financial: bool, reason: str)
+    Given the file's content_hash, the result is kept in memory so the same bytes
+    aren't classified twice; results of failed classifications are not kept.
+    """
+    if content_hash is not None:
+        with _classifications_lock:
+            result = _classifications.get(content_hash)
+            if result is not None:
+                _classifications.move_to_end(content_hash)
+                return result
+    
+    result = _classify_pdf(pdf_path)
+    if content_hash is not None and not result[1].startswith(CLASSIFY_ERROR_PREFIX):
+        with _classifications_lock:
+            _classifications[content_hash] = result
+            while len(_classifications) > CLASSIFY_CACHE_SIZE:
+                _classifications.popitem(last=False)
+    return result
+
+
+def _statement_text(doc: Document, page_texts: List[str]) -> Tuple[str, str, str]:
+    """
+    Return (first_pages_text, pnl_text, bs_text): the cover pages for metadata
+    plus the pages that look like the P&L and Balance Sheet, each clipped to its
+    prompt token budget.
+    """
+    # 1) Meta (company, period) from first 2-3 pages
+    first_pages_text = "\n\n".join(page_texts[:3])
+
+    # 2) Find P&L and Balance Sheet pages
+    pnl_indices, bs_indices = _classify_pages(page_texts)
+
+    if pnl_indices:
+        pnl_text = "\n\n".join(page_texts[idx] for idx in pnl_indices)
+    else:
+        logger.warning("No P&L pages detected for doc %s, using full text as fallback", doc.id)
+        pnl_text = "\n\n".join(page_texts[:10])
+
+    if bs_indices:
+        bs_text = "\n\n".join(page_texts[idx] for idx in bs_indices)
+    else:
+        logger.warning("No Balance Sheet pages detected for doc %s, using full text as fallback", doc.id)
+        bs_text = "\n\n".join(page_texts[:10])
+
+    return (
+        clip_to_tokens(first_pages_text, META_MAX_TOKENS),
+        clip_to_tokens(pnl_text, STATEMENT_MAX_TOKENS),
+        clip_to_tokens(bs_text, STATEMENT_MAX_TOKENS),
+    )
+
+
+async def _store_chunks(
+    doc: Document, db: Session, page_texts: List[str]
+) -> Tuple[List[int], np.ndarray | None, List[int]]:
+    """
+    Chunk the already-extracted page texts and store embeddings for RAG.
+
+    Chunks are produced lazily and handled in CHUNK_BATCH_SIZE batches: each
+    batch is embedded as its own request (up to CHUNK_PIPELINE_DEPTH in flight)
+    and inserted as soon as it returns, so only a few batches of chunk text are
+    resident at a time. Rows are written in a savepoint and left for the caller
+    to commit; returns the embedded chunk ids, their vectors and keyword flag
+    masks for the vector store, to be added once committed.
+    """
+    chunk_ids: list[int] = []
+    chunk_vectors: list[np.ndarray] = []
+    chunk_flags: list[int] = []
+    in_flight: deque[tuple[list[tuple[int, int, str]], asyncio.Task]] = deque()
+    stored = 0
+
+    def save(batch: list[tuple[int, int, str]], vectors: np.ndarray | None) -> None:
+        # One executemany INSERT per batch; ids come back in input order so the
+        # vectors can be indexed for similarity search
+        rows = [
+            {
+                "document_id": doc.id,
+                "page_number": page_num,
+                "chunk_index": chunk_idx,
+                "text": ch,
+                "embedding": vectors[i] if vectors is not None else None,  # packed to float16 bytes by EmbeddingVector
+                **chunk_keyword_flags(ch),
+            }
+            for i, (page_num, chunk_idx, ch) in enumerate(batch)
+        ]
+        ids = db.scalars(
+            insert(DocumentChunk).returning(DocumentChunk.id, sort_by_parameter_order=True),
+            rows,
+        ).all()
+        if vectors is not None:
+            chunk_ids.extend(ids)
+            chunk_vectors.append(vectors)
+            chunk_flags.extend(vector_store.pack_flags(row) for row in rows)
+
+    async def drain_one() -> None:
+        nonlocal stored
+        batch, task = in_flight.popleft()
+        try:
+            vectors = await task
+            if len(vectors) != len(batch):
+                raise RuntimeError(f"expected {len(batch)} embeddings, got {len(vectors)}")
+        except Exception as e:
+            # Log but don't crash the entire parse. RAG will just be unavailable for these chunks.
+            logger.exception("Embedding failed for a batch of document %s: %s", doc.id, e)
+            vectors = None
+        await asyncio.to_thread(save, batch, vectors)
+        stored += len(batch)
+
+    try:
+        # The savepoint and inserts go through worker threads, the embedding
+        # requests stay on the event loop
+        savepoint = await asyncio.to_thread(db.begin_nested)
+        try:
+            for batch in _batched(iter_chunks(page_texts), CHUNK_BATCH_SIZE):
+                task = asyncio.create_task(acached_embed_texts([ch for _, _, ch in batch]))
+                in_flight.append((batch, task))
+                if len(in_flight) >= CHUNK_PIPELINE_DEPTH:
+                    await drain_one()
+            while in_flight:
+                await drain_one()
+        except BaseException:
+            await asyncio.to_thread(savepoint.rollback)
+            raise
+        await asyncio.to_thread(savepoint.commit)
+        
+        if stored:
+            logger.info(
+                "Stored %d chunks (%d embedded) for document %s", stored, len(chunk_ids), doc.id
+            )
+        else:
+            logger.warning("No text chunks extracted for document %s", doc.id)
+        return chunk_ids, np.concatenate(chunk_vectors) if chunk_vectors else None, chunk_flags
+            
+    except Exception as e:
+        # Log but don't fail the entire parsing if chunking/embedding fails;
+        # the savepoint rollback discards any chunks already inserted
+        for _, task in in_flight:
+            task.cancel()
+        logger.exception("Error during chunking/embedding for document %s: %s", doc.id, e)
+        return [], None, []
+
+
+def _split_financials(raw: str) -> Tuple[Dict[str, Any], Dict[str, Any]] | None:
+    """
+    Split a combined extraction response into the ({"metrics": [...]} P&L,
+    {"metrics": [...]} Balance Sheet) shape used by the single-statement prompts.
+    Returns None if the response doesn't have both lists.
+    """
+    combined = _extract_json(raw, "combined financial metrics")
+    if not isinstance(combined, dict):
+        return None
+    pnl_metrics = combined.get("pnl_metrics")
+    bs_metrics = combined.get("bs_metrics")
+    if not isinstance(pnl_metrics, list) or not isinstance(bs_metrics, list):
+        logger.warning("Combined financial metrics missing pnl_metrics/bs_metrics: %r", raw[:500])
+        return None
+    return {"metrics": pnl_metrics}, {"metrics": bs_metrics}
+
+
+async def parse_pdf_and_populate_metrics(
+    doc: Document, db: Session
+) -> Tuple[str | None, str | None]:
     """
     Parse a balance sheet / annual report PDF and populate:
     - doc.company_name, doc.fiscal_year
     - FinancialMetric rows (document_id-based) for:
       revenue, net_profit, total_assets, total_liabilities
+    The PDF is opened once and each page's text extracted once (in a worker
+    thread); chunk embeddings are requested as concurrent async batches. Metadata and a combined
+    P&L + Balance Sheet extraction are requested concurrently; if the combined
+    response is unusable, the per-statement prompts are sent instead.
+    Returns the parsed (company_name, fiscal_year), so callers needn't reload doc
+    after the commit expires it.
     """
-    logger.info("Parsing PDF for document id=%s, path=%s", doc.id, doc.storage_path)
+    document_id = doc.id
+    logger.info("Parsing PDF for document id=%s, path=%s", document_id, doc.storage_path)
 
     try:
-        with pdfplumber.open(doc.storage_path) as pdf:
-            pages = pdf.pages
+        # Each page is extracted exactly once and reused for every step below
+        page_texts = await asyncio.to_thread(extract_page_texts, doc.storage_path)
+    except Exception:
+        logger.exception("Error while reading PDF for doc %s", doc.id)
+        raise
 
-            # 1) Meta (company, period) from first 2-3 pages
-            first_pages_text = "\n\n".join(
-                (pages[i].extract_text() or "") for i in range(min(3, len(pages)))
-            )
+    first_pages_text, pnl_text, bs_text = _statement_text(doc, page_texts)
 
-            meta_system = (
-                "You are reading the cover/intro pages of an annual report or balance sheet. "
-                "Extract structured metadata."
-            )
-            meta_user = f"""
+    meta_system = (
+        "You are reading the cover/intro pages of an annual report or balance sheet. "
+        "Extract structured metadata."
+    )
+    meta_user = f"""
 Here is the text from the first pages of an annual report:
 
 \"\"\"{first_pages_text}\"\"\"
@@ -208,57 +697,8 @@ Example:
   "financial_year": "Year ended 31 March 2024"
 }}
 """
-            meta_raw = call_llm(meta_system, meta_user)
-            meta = _extract_json(meta_raw, "company meta")
-            if isinstance(meta, dict):
-                doc.company_name = meta.get("company_name") or doc.company_name
-                doc.fiscal_year = meta.get("financial_year") or doc.fiscal_year
-                db.add(doc)
-                db.commit()
-                logger.info(
-                    "Meta parsed for doc %s: company=%r, year=%r",
-                    doc.id,
-                    doc.company_name,
-                    doc.fiscal_year,
-                )
-            else:
-                logger.warning("Meta JSON not parsed for doc %s", doc.id)
-
-            # 2) Find P&L and Balance Sheet pages
-            pnl_indices = _find_pages_with_keywords(
-                pdf, ["statement of profit and loss", "profit and loss", "statement of profit"]
-            )
-            bs_indices = _find_pages_with_keywords(
-                pdf, ["balance sheet", "statement of financial position"]
-            )
-
-            pnl_text = ""
-            bs_text = ""
 
-            if pnl_indices:
-                # take those pages and maybe one following page
-                for idx in pnl_indices:
-                    pnl_text += pages[idx].extract_text() or ""
-                    if idx + 1 < len(pages):
-                        pnl_text += "\n\n" + (pages[idx + 1].extract_text() or "")
-            else:
-                logger.warning("No P&L pages detected for doc %s, using full text as fallback", doc.id)
-                pnl_text = "\n\n".join(page.extract_text() or "" for page in pages[:10])
-
-            if bs_indices:
-                for idx in bs_indices:
-                    bs_text += pages[idx].extract_text() or ""
-                    if idx + 1 < len(pages):
-                        bs_text += "\n\n" + (pages[idx + 1].extract_text() or "")
-            else:
-                logger.warning("No Balance Sheet pages detected for doc %s, using full text as fallback", doc.id)
-                bs_text = "\n\n".join(page.extract_text() or "" for page in pages[:10])
-
-    except Exception:
-        logger.exception("Error while reading PDF for doc %s", doc.id)
-        return
-
-    # 3) Extract P&L metrics (revenue, net_profit) per year using LLM
+    # 3) P&L metrics (revenue, net_profit) per year (fallback prompt)
     pnl_system = (
         "You are extracting structured financial metrics from a company's consolidated "
         "statement of profit and loss."
@@ -292,39 +732,7 @@ Use integer years (e.g., 2022). If a value is not clearly available, omit that y
 Values should be numeric (floats), no commas or currency symbols.
 """
 
-    pnl_raw = call_llm(pnl_system, pnl_user)
-    pnl = _extract_json(pnl_raw, "P&L metrics")
-
-    # Helper to insert metrics
-    def insert_metric(year: int, name: str, value: float, unit: str = "INR"):
-        if value is None:
-            return
-        try:
-            v = float(value)
-        except Exception:
-            return
-        fm = FinancialMetric(
-            document_id=doc.id,
-            year=year,
-            metric_name=name,
-            value=v,
-            unit=unit,
-        )
-        db.add(fm)
-
-    if isinstance(pnl, dict):
-        for item in pnl.get("metrics", []):
-            year = item.get("year")
-            if not isinstance(year, int):
-                continue
-            insert_metric(year, "revenue", item.get("revenue"))
-            insert_metric(year, "net_profit", item.get("net_profit"))
-        db.commit()
-        logger.info("Inserted P&L metrics for doc %s", doc.id)
-    else:
-        logger.warning("P&L JSON not parsed for doc %s", doc.id)
-
-    # 4) Extract Balance Sheet metrics (assets, liabilities) per year
+    # 4) Balance Sheet metrics (assets, liabilities) per year (fallback prompt)
     bs_system = (
         "You are extracting structured financial metrics from a company's consolidated balance sheet."
     )
@@ -357,76 +765,162 @@ Use integer years (e.g., 2022). If a value is not clearly available, omit that y
 Values should be numeric (floats), no commas or currency symbols.
 """
 
-    bs_raw = call_llm(bs_system, bs_user)
-    bs = _extract_json(bs_raw, "Balance Sheet metrics")
+    # Combined P&L + Balance Sheet extraction: one round-trip and one prefill
+    # instead of two. The single-statement prompts above are the fallback.
+    financials_system = (
+        "You are extracting structured financial metrics from a company's consolidated "
+        "financial statements (statement of profit and loss and balance sheet)."
+    )
+    financials_user = f"""
+You are given text/tables from a company's consolidated financial statements.
 
-    if isinstance(bs, dict):
-        for item in bs.get("metrics", []):
-            year = item.get("year")
-            if not isinstance(year, int):
-                continue
-            insert_metric(year, "total_assets", item.get("total_assets"))
-            insert_metric(year, "total_liabilities", item.get("total_liabilities"))
-        db.commit()
-        logger.info("Inserted Balance Sheet metrics for doc %s", doc.id)
+Statement of profit and loss:
+\"\"\"{pnl_text}\"\"\"
+
+Balance sheet:
+\"\"\"{bs_text}\"\"\"
+
+From this text, identify for each financial year where data is clearly reported:
+- revenue: total revenue (or 'Revenue from operations' / 'Total income'), from the P&L
+- net_profit: net profit (PAT) (profit for the year attributable to owners, or consolidated profit), from the P&L
+- total_assets: total assets, from the balance sheet
+- total_liabilities: total liabilities (including non-current and current, but not equity), from the balance sheet
+
+Return ONLY valid JSON of the form:
+{{
+  "pnl_metrics": [
+    {{"year": 2023, "revenue": 123456.0, "net_profit": 7890.0}}
+  ],
+  "bs_metrics": [
+    {{"year": 2023, "total_assets": 111111.0, "total_liabilities": 99999.0}}
+  ]
+}}
+
+Use integer years (e.g., 2022). If a value is not clearly available, use null; omit years with no data.
+Values should be numeric (floats), no commas or currency symbols.
+"""
+
+    # Metadata and financials are independent: overlap the round-trips
+    # Responses are parsed as they arrive; only ones that parse are cached
+    meta, financials = await asyncio.gather(
+        acached_call_llm(
+            meta_system, meta_user, parse=partial(_extract_json_object, context="company meta")
+        ),
+        acached_call_llm(
+            financials_system, financials_user, llm_fn=_acall_financials_llm, parse=_split_financials
+        ),
+    )
+    if financials is not None:
+        pnl, bs = financials
     else:
-        logger.warning("Balance Sheet JSON not parsed for doc %s", doc.id)
-    
-    # 5) Extract full text, chunk it, and store embeddings for RAG
+        logger.warning("Combined extraction failed for doc %s, retrying per statement", doc.id)
+        pnl, bs = await asyncio.gather(
+            acached_call_llm(
+                pnl_system, pnl_user, parse=partial(_extract_json_object, context="P&L metrics")
+            ),
+            acached_call_llm(
+                bs_system, bs_user, parse=partial(_extract_json_object, context="Balance Sheet metrics")
+            ),
+        )
+
+    if meta is not None:
+        doc.company_name = meta.get("company_name") or doc.company_name
+        doc.fiscal_year = meta.get("financial_year") or doc.fiscal_year
+        logger.info(
+            "Meta parsed for doc %s: company=%r, year=%r",
+            doc.id,
+            doc.company_name,
+            doc.fiscal_year,
+        )
+    else:
+        logger.warning("Meta JSON not parsed for doc %s", doc.id)
+
+    # Helper to collect metric rows; each section is written with one bulk INSERT
+    metric_rows: list[dict[str, Any]] = []
+
+    def insert_metric(year: int, name: str, value: float, unit: str = "INR"):
+        if value is None:
+            return
+        try:
+            v = float(value)
+        except Exception:
+            return
+        metric_rows.append({
+            "document_id": doc.id,
+            "year": year,
+            "metric_name": name,
+            "value": v,
+            "unit": unit,
+        })
+
+    def flush_metrics():
+        if metric_rows:
+            db.execute(insert(FinancialMetric), metric_rows)
+            metric_rows.clear()
+
+    # Each section is isolated in a savepoint so a failed insert doesn't discard
+    # the others; everything is committed together at the end
+    def write_metrics() -> None:
+        if isinstance(pnl, dict):
+            try:
+                with db.begin_nested():
+                    for item in pnl.get("metrics", []):
+                        year = item.get("year")
+                        if not isinstance(year, int):
+                            continue
+                        insert_metric(year, "revenue", item.get("revenue"))
+                        insert_metric(year, "net_profit", item.get("net_profit"))
+                    flush_metrics()
+                logger.info("Inserted P&L metrics for doc %s", document_id)
+            except Exception:
+                metric_rows.clear()
+                logger.exception("Failed to insert P&L metrics for doc %s", document_id)
+        else:
+            logger.warning("P&L JSON not parsed for doc %s", document_id)
+
+        if isinstance(bs, dict):
+            try:
+                with db.begin_nested():
+                    for item in bs.get("metrics", []):
+                        year = item.get("year")
+                        if not isinstance(year, int):
+                            continue
+                        insert_metric(year, "total_assets", item.get("total_assets"))
+                        insert_metric(year, "total_liabilities", item.get("total_liabilities"))
+                    flush_metrics()
+                logger.info("Inserted Balance Sheet metrics for doc %s", document_id)
+            except Exception:
+                metric_rows.clear()
+                logger.exception("Failed to insert Balance Sheet metrics for doc %s", document_id)
+        else:
+            logger.warning("Balance Sheet JSON not parsed for doc %s", document_id)
+
+    def mark_processed() -> Tuple[str | None, str | None]:
+        # Mark document as processed after successful parsing
+        doc.processed_at = datetime.utcnow()
+        db.add(doc)
+        parsed = doc.company_name, doc.fiscal_year
+        db.commit()
+        return parsed
+
+    # Database and index writes are blocking, so like the extraction they run
+    # off the event loop; only the LLM and embedding requests are awaited on it
     try:
-        # Reopen PDF to extract full text (we closed it earlier)
-        with pdfplumber.open(doc.storage_path) as pdf:
-            pages = pdf.pages
-            
-            # Extract text from all pages
-            page_texts: list[str] = []
-            for page in pages:
-                t = page.extract_text() or ""
-                page_texts.append(t)
-            
-            # Build chunk tuples (page_number, chunk_index, text)
-            raw_chunks: list[tuple[int, int, str]] = []
-            for page_idx, text in enumerate(page_texts):
-                if not text.strip():
-                    continue
-                page_chunks = chunk_text(text)
-                for ci, ch in enumerate(page_chunks):
-                    raw_chunks.append((page_idx + 1, ci, ch))  # 1-based page numbers
-            
-            # Embed and store chunks
-            if raw_chunks:
-                texts_to_embed = [ch for (_, _, ch) in raw_chunks]
-                try:
-                    logger.info("Embedding %d chunks for document %s", len(texts_to_embed), doc.id)
-                    vectors = embed_texts(texts_to_embed)
-                    logger.info("Successfully embedded %d chunks for document %s", len(vectors), doc.id)
-                except Exception as e:
-                    # Log but don't crash the entire parse. RAG will just be unavailable.
-                    logger.exception("Embedding failed for document %s: %s", doc.id, e)
-                    vectors = [None] * len(raw_chunks)
-                
-                # Store chunks with embeddings
-                for (page_num, chunk_idx, ch), emb in zip(raw_chunks, vectors):
-                    dc = DocumentChunk(
-                        document_id=doc.id,
-                        page_number=page_num,
-                        chunk_index=chunk_idx,
-                        text=ch,
-                        embedding=emb,  # JSON column stores list directly
-                    )
-                    db.add(dc)
-                
-                db.commit()
-                logger.info("Stored %d chunks for document %s", len(raw_chunks), doc.id)
-            else:
-                logger.warning("No text chunks extracted for document %s", doc.id)
-                
-    except Exception as e:
-        # Log but don't fail the entire parsing if chunking/embedding fails
-        logger.exception("Error during chunking/embedding for document %s: %s", doc.id, e)
-    
-    # Mark document as processed after successful parsing
-    doc.processed_at = datetime.utcnow()
-    db.add(doc)
-    db.commit()
-    logger.info("Marked document %s as processed", doc.id)
+        await asyncio.to_thread(write_metrics)
+        
+        # 5) Extract full text, chunk it, and store embeddings for RAG
+        chunk_ids, chunk_vectors, chunk_flags = await _store_chunks(doc, db, page_texts)
+        
+        parsed = await asyncio.to_thread(mark_processed)
+    except BaseException:
+        await asyncio.to_thread(db.rollback)
+        raise
+    logger.info("Marked document %s as processed", document_id)
+
+    # Only index vectors whose rows are committed
+    if chunk_ids:
+        await asyncio.to_thread(
+            vector_store.add, document_id, chunk_ids, chunk_vectors, chunk_flags
+        )
+    metrics_cache.invalidate(document_id)
+    return parsed
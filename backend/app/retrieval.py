@@ -1,30 +1,103 @@
+import re
+from functools import lru_cache
 from typing import List
-from math import sqrt
+
+import numpy as np
 from sqlalchemy.orm import Session
 
+from app import vector_store
 from app.models import DocumentChunk
 from app.llm import embed_texts
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on chunks scored per query on very large documents (see
+# vector_store.scores); wide enough that keyword boosts can still reorder them
+RERANK_CANDIDATES = 512
+
+# Query embeddings kept in memory (768 float32 = 3 KB each)
+QUERY_EMBEDDING_CACHE_SIZE = 2048
+
+# Question intent steering: a question containing one of the trigger words has
+# its embedding blended with the embedding of the matching anchor text, so the
+# search leans towards that kind of passage without lengthening the query itself
+MANAGEMENT_INTENT_TRIGGERS = ["reason", "why", "explain", "management", "factor"]
+MANAGEMENT_INTENT_ANCHOR = (
+    "management discussion analysis MD&A explanation rationale strategy outlook risk opportunity "
+    "performance factors growth challenges initiatives"
+)
+FINANCIAL_INTENT_TRIGGERS = ["revenue", "profit", "financial"]
+FINANCIAL_INTENT_ANCHOR = (
+    "financial statement balance sheet profit loss revenue income expense asset liability"
+)
+INTENT_ANCHOR_WEIGHT = 0.3
+
+# Keyword sets for question typing and chunk boosting. Each set is compiled into
+# one alternation so a text is scanned once per set instead of once per keyword.
+MANAGEMENT_QUESTION_KEYWORDS = [
+    "management", "reason", "explain", "why", "cause", "factor", "discussion",
+    "analysis", "outlook", "strategy", "risk", "opportunity", "challenge"
+]
+FINANCIAL_QUESTION_KEYWORDS = [
+    "revenue", "profit", "asset", "liability", "cash flow", "margin", "ratio"
+]
+MDA_KEYWORDS = [
+    "management discussion", "management's discussion", "mda", "md&a",
+    "management analysis", "outlook", "strategy", "risk factor",
+    "key factor", "reason", "explanation", "performance", "growth",
+    "challenge", "opportunity", "initiative"
+]
+FINANCIAL_STATEMENT_KEYWORDS = [
+    "statement of profit", "balance sheet", "cash flow",
+    "financial position", "revenue", "profit", "asset", "liability"
+]
+
+
+def _keyword_re(keywords: List[str]) -> re.Pattern:
+    # Longest first so overlapping keywords don't shadow each other
+    return re.compile("|".join(re.escape(kw) for kw in sorted(keywords, key=len, reverse=True)))
+
+
+_MANAGEMENT_QUESTION_RE = _keyword_re(MANAGEMENT_QUESTION_KEYWORDS)
+_FINANCIAL_QUESTION_RE = _keyword_re(FINANCIAL_QUESTION_KEYWORDS)
+_MDA_RE = _keyword_re(MDA_KEYWORDS)
+_FINANCIAL_STATEMENT_RE = _keyword_re(FINANCIAL_STATEMENT_KEYWORDS)
+
 
-def _cosine_similarity(a: list[float], b: list[float]) -> float:
+def chunk_keyword_flags(text: str) -> dict[str, bool]:
     """
-    Compute cosine similarity between two vectors.
-    Returns a value between -1 and 1, where 1 means identical.
+    Keyword flags used for boosting, keyed by DocumentChunk column name.
+    Computed once per chunk at ingest so queries don't rescan chunk text.
     """
-    if len(a) != len(b):
-        return 0.0
-    
-    dot = sum(x * y for x, y in zip(a, b))
-    norm_a = sqrt(sum(x * x for x in a))
-    norm_b = sqrt(sum(x * x for x in b))
-    
-    if norm_a == 0 or norm_b == 0:
-        return 0.0
-    
-    return dot / (norm_a * norm_b)
+    text_lower = text.lower()
+    return {
+        "has_mda": _MDA_RE.search(text_lower) is not None,
+        "has_financial": _FINANCIAL_STATEMENT_RE.search(text_lower) is not None,
+        "has_auditor": "independent auditor" in text_lower,
+    }
+
+
+@lru_cache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)
+def _embed_query(text: str) -> np.ndarray:
+    """
+    Embedding of a (whitespace-normalized) query; repeated questions skip the API call.
+    Raises RuntimeError if embedding failed, so failures aren't cached.
+    """
+    vecs = embed_texts([text])
+    if len(vecs) == 0:
+        raise RuntimeError("query embedding failed")
+    vec = vecs[0]
+    vec.setflags(write=False)  # shared between callers
+    return vec
+
+
+def _intent_anchor(question_lower: str) -> str | None:
+    if any(keyword in question_lower for keyword in MANAGEMENT_INTENT_TRIGGERS):
+        return MANAGEMENT_INTENT_ANCHOR
+    if any(keyword in question_lower for keyword in FINANCIAL_INTENT_TRIGGERS):
+        return FINANCIAL_INTENT_ANCHOR
+    return None
 
 
 def retrieve_relevant_chunks(
@@ -42,123 +115,79 @@ def retrieve_relevant_chunks(
         return []
     
     try:
-        # 1) Expand question for better retrieval (especially for management questions)
-        question_lower = question.lower()
-        expanded_question = question
-        
-        # For management-related questions, expand with synonyms and related terms
-        if any(keyword in question_lower for keyword in ["reason", "why", "explain", "management", "factor"]):
-            expanded_question = (
-                f"{question} "
-                "management discussion analysis MD&A explanation rationale strategy outlook risk opportunity "
-                "performance factors growth challenges initiatives"
-            )
-        elif any(keyword in question_lower for keyword in ["revenue", "profit", "financial"]):
-            expanded_question = (
-                f"{question} "
-                "financial statement balance sheet profit loss revenue income expense asset liability"
-            )
-        
-        # Embed the expanded question for better retrieval
-        q_vecs = embed_texts([expanded_question])
-        if not q_vecs or len(q_vecs) == 0:
+        # 1) Embed the question (whitespace variants share a cache entry) and steer it
+        #  towards its intent's anchor (especially for management questions). The
+        #  anchors go through the same cache, so each is embedded once per process.
+        anchor = _intent_anchor(question.lower())
+        try:
+            q_vec = _embed_query(" ".join(question.split()))
+            if anchor is not None:
+                anchor_vec = _embed_query(anchor)
+                q_vec = (
+                    (1 - INTENT_ANCHOR_WEIGHT) * q_vec / (np.linalg.norm(q_vec) or 1.0)
+                    + INTENT_ANCHOR_WEIGHT * anchor_vec / (np.linalg.norm(anchor_vec) or 1.0)
+                )
+        except RuntimeError:
             logger.warning("Failed to embed question for document %s", document_id)
             return []
-        q_vec = q_vecs[0]
-        
-        # 2) Load all chunks for this document
-        chunks = (
-            db.query(DocumentChunk)
-            .filter(DocumentChunk.document_id == document_id)
-            .all()
-        )
-        
-        if not chunks:
-            logger.info("No chunks found for document %s", document_id)
-            return []
         
-        # 3) Detect question type for keyword boosting
+        # 2) Detect question type for keyword boosting
         question_lower = question.lower()
-        is_management_question = any(keyword in question_lower for keyword in [
-            "management", "reason", "explain", "why", "cause", "factor", "discussion",
-            "analysis", "outlook", "strategy", "risk", "opportunity", "challenge"
-        ])
-        is_financial_question = any(keyword in question_lower for keyword in [
-            "revenue", "profit", "asset", "liability", "cash flow", "margin", "ratio"
-        ])
-        
-        # 4) Compute similarity scores with keyword boosting
-        scored: list[tuple[float, str, int]] = []  # (score, text, page_number)
-        for ch in chunks:
-            if not ch.embedding:
-                continue
-            
-            emb = ch.embedding  # JSON column stores list directly
-            if not isinstance(emb, list) or len(emb) == 0:
-                continue
-            
-            try:
-                # Base similarity score
-                base_score = _cosine_similarity(q_vec, emb)
-                
-                # Keyword-based boosting
-                chunk_text_lower = ch.text.lower()
-                boost = 0.0
-                
-                # Boost MD&A/management discussion chunks for management questions
-                if is_management_question:
-                    mda_keywords = [
-                        "management discussion", "management's discussion", "mda", "md&a",
-                        "management analysis", "outlook", "strategy", "risk factor",
-                        "key factor", "reason", "explanation", "performance", "growth",
-                        "challenge", "opportunity", "initiative"
-                    ]
-                    if any(keyword in chunk_text_lower for keyword in mda_keywords):
-                        boost += 0.15  # Significant boost for MD&A content
-                
-                # Boost financial statement chunks for financial questions
-                if is_financial_question:
-                    financial_keywords = [
-                        "statement of profit", "balance sheet", "cash flow",
-                        "financial position", "revenue", "profit", "asset", "liability"
-                    ]
-                    if any(keyword in chunk_text_lower for keyword in financial_keywords):
-                        boost += 0.1
-                
-                # Slight penalty for audit-only chunks when asking management questions
-                if is_management_question and "auditor" in chunk_text_lower and "independent auditor" in chunk_text_lower:
-                    boost -= 0.1
-                
-                final_score = base_score + boost
-                scored.append((final_score, ch.text, ch.page_number or 0))
-            except Exception as e:
-                logger.warning("Error computing similarity for chunk %s: %s", ch.id, e)
-                continue
-        
-        if not scored:
-            logger.info("No chunks with valid embeddings for document %s", document_id)
-            return []
+        is_management_question = _MANAGEMENT_QUESTION_RE.search(question_lower) is not None
+        is_financial_question = _FINANCIAL_QUESTION_RE.search(question_lower) is not None
         
-        # 5) Sort by final score descending
-        scored.sort(key=lambda x: x[0], reverse=True)
+        # 3) Rank the embedded chunks of this document by similarity, keyword boosts
+        #  included (per vector_store.FLAG_COLUMNS, using the flags stored at ingest):
+        #  +0.15 MD&A content for management questions, +0.1 financial statement
+        #  content for financial questions, -0.1 audit report text for management questions
+        flag_boosts = (
+            0.15 if is_management_question else 0.0,
+            0.1 if is_financial_question else 0.0,
+            -0.1 if is_management_question else 0.0,
+        )
         
-        # 6) Return top_k texts (deduplicate very similar chunks)
+        # 4) Return top_k texts (deduplicate very similar chunks). Only the best
+        #  top_k * 2 are ranked and have their texts fetched by primary key; the
+        #  headroom absorbs dedup skips, and the window doubles if it runs out.
         result_texts = []
-        seen_texts = set()
-        for score, text, page_num in scored:
-            # Simple deduplication: skip if very similar text already included
-            text_snippet = text[:100].lower().strip()
-            if text_snippet not in seen_texts:
-                result_texts.append(text)
-                seen_texts.add(text_snippet)
-                if len(result_texts) >= top_k:
-                    break
+        seen_snippets: set[str] = set()  # normalized leading snippets of included chunks
+        consumed = 0
+        window = max(top_k * 2, 1)
+        top_score = None
+        while len(result_texts) < top_k:
+            chunk_ids, final_scores = vector_store.search(
+                db, document_id, q_vec, window, max_candidates=RERANK_CANDIDATES, flag_boosts=flag_boosts
+            )
+            if top_score is None:
+                if not len(chunk_ids):
+                    logger.info("No chunks with valid embeddings for document %s", document_id)
+                    return []
+                top_score = float(final_scores[0])
+            fresh = chunk_ids[consumed:].tolist()
+            if not fresh:
+                break
+            consumed = len(chunk_ids)
+            texts = dict(
+                db.query(DocumentChunk.id, DocumentChunk.text).filter(DocumentChunk.id.in_(fresh)).all()
+            )
+            for chunk_id in fresh:
+                text = texts.get(chunk_id)
+                if text is None:
+                    continue  # deleted since it was indexed
+                # Simple deduplication: skip if very similar text already included
+                snippet = text[:100].lower().strip()
+                if snippet not in seen_snippets:
+                    result_texts.append(text)
+                    seen_snippets.add(snippet)
+                    if len(result_texts) >= top_k:
+                        break
+            window *= 2
         
         logger.info(
             "Retrieved %d chunks for document %s (top similarity: %.4f, question type: %s)",
             len(result_texts),
             document_id,
-            scored[0][0] if scored else 0.0,
+            top_score,
             "management" if is_management_question else "financial" if is_financial_question else "general"
         )
         return result_texts
@@ -1,43 +1,76 @@
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import and_, func, select
 from sqlalchemy.orm import Session
-from typing import List, Tuple, Dict
-import math
+from typing import Any, List, Tuple, Dict
+import asyncio
+import logging
 import re
 
+import numpy as np
+
+from app import metrics_cache
 from app.database import get_db
 from app.models import Company, FinancialMetric, Document
 from app.schemas import ChatRequest, ChatResponse, ChartData, ChartSeries
-from app.llm import call_llm
+from app.llm import acall_llm
 from app.retrieval import retrieve_relevant_chunks
-from app.charts import plan_chart_config, build_chart_data_from_plan
+from app.charts import aplan_chart_config, build_chart_data_from_plan
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 
 def get_last_n_years_metrics(
-    db: Session, company_id: int, metric_names: List[str], n: int = 3
-) -> Tuple[List[int], Dict[str, Dict[int, float]]]:
+    db: Session, company_code: str, metric_names: List[str], n: int = 3
+) -> Tuple[str | None, List[int], Dict[str, Dict[int, float]]]:
     """
-    Returns (years, {metric_name: {year: value}}) for company-based metrics
+    Returns (company_name, years, {metric_name: {year: value}}) for company-based metrics.
+    company_name is None if there is no company with that code.
     """
-    q = (
-        db.query(FinancialMetric)
-        .filter(
-            FinancialMetric.company_id == company_id,
-            FinancialMetric.metric_name.in_(metric_names),
+    # Rank each metric's years newest first so only the last n come back from the DB
+    ranked = (
+        select(
+            FinancialMetric.company_id,
+            FinancialMetric.metric_name,
+            FinancialMetric.year,
+            FinancialMetric.value,
+            func.dense_rank()
+            .over(partition_by=FinancialMetric.metric_name, order_by=FinancialMetric.year.desc())
+            .label("year_rank"),
         )
-        .order_by(FinancialMetric.year.desc())
+        .join(Company, Company.id == FinancialMetric.company_id)
+        .where(Company.code == company_code, FinancialMetric.metric_name.in_(metric_names))
+        .subquery()
     )
-    rows = q.all()
+    # Company and its metrics in one round trip; the outer join keeps a
+    # (name, None, None, None) row for a company without metrics
+    rows = db.execute(
+        select(Company.name, ranked.c.metric_name, ranked.c.year, ranked.c.value)
+        .outerjoin(ranked, and_(ranked.c.company_id == Company.id, ranked.c.year_rank <= n))
+        .where(Company.code == company_code)
+        .order_by(ranked.c.year.desc())
+    ).all()
+    if not rows:
+        return None, [], {}
     result = {m: {} for m in metric_names}
     years = set()
-    for row in rows:
-        if len(result[row.metric_name]) >= n:
+    for _, metric_name, year, value in rows:
+        if metric_name is None:
             continue
-        result[row.metric_name][row.year] = row.value
-        years.add(row.year)
+        result[metric_name][year] = value
+        years.add(year)
     years = sorted(list(years))
-    return years, result
+    return rows[0].name, years, result
+
+
+def _get_document(db: Session, document_id: int):
+    """
+    The columns of a document chat_query needs, or None if it doesn't exist.
+    """
+    return db.execute(
+        select(Document.id, Document.company_name, Document.fiscal_year, Document.processed_at)
+        .where(Document.id == document_id)
+    ).first()
 
 
 def get_metrics_for_document(
@@ -47,64 +80,98 @@ def get_metrics_for_document(
     Returns (years, {metric_name: {year: value}}) for document-based metrics.
     Gets all available metrics (up to n years) from the uploaded document.
     """
-    q = (
-        db.query(FinancialMetric)
-        .filter(
+    # Project only the three needed columns; the filter and ordering are
+    # served by ix_fm_doc_metric_year, so the rows come back without a sort
+    rows = db.execute(
+        select(FinancialMetric.year, FinancialMetric.metric_name, FinancialMetric.value)
+        .where(
             FinancialMetric.document_id == document_id,
             FinancialMetric.metric_name.in_(metric_names),
         )
-        .order_by(FinancialMetric.year.desc())
-    )
-    rows = q.all()
+        .order_by(FinancialMetric.metric_name, FinancialMetric.year.desc())
+    ).all()
     result = {m: {} for m in metric_names}
     years = set()
-    for row in rows:
-        if len(result[row.metric_name]) >= n:
+    for year, metric_name, value in rows:
+        if len(result[metric_name]) >= n:
             continue
-        result[row.metric_name][row.year] = row.value
-        years.add(row.year)
+        result[metric_name][year] = value
+        years.add(year)
     years = sorted(list(years))
     return years, result
+
+
+class _LetterFilter(dict):
+    """
+    str.translate table that deletes every character that isn't a letter or
+    whitespace. Filled in per code point on first sight, so translate stays a
+    single C-level pass over the text.
+    """
+    def __missing__(self, codepoint: int) -> int | None:
+        ch = chr(codepoint)
+        keep = codepoint if ch.isalpha() or ch.isspace() else None
+        self[codepoint] = keep
+        return keep
+
+
+_LETTERS_ONLY = _LetterFilter()
+
+
 def _normalize(text: str) -> str:
     # keep letters and spaces, lowercase
-    return "".join(ch for ch in text.lower() if ch.isalpha() or ch.isspace()).strip()
+    return text.lower().translate(_LETTERS_ONLY).strip()
 
-def _is_greeting(text: str) -> bool:
-    normalized = _normalize(text)
-    greeting_keywords = [
-        "hi", "hello", "hey", "good morning", "good afternoon", "good evening",
-    ]
-    return any(
-        normalized == kw or normalized.startswith(kw + " ")
-        for kw in greeting_keywords
-    ) and len(normalized.split()) <= 5
-
-def _is_smalltalk_or_overview(text: str) -> bool:
+GREETING_KEYWORDS = [
+    "hi", "hello", "hey", "good morning", "good afternoon", "good evening",
+]
+# phrases that usually mean "give me a quick overview"
+OVERVIEW_PHRASES = [
+    "overview", "high level", "highlevel", "summary", "quick summary",
+    "tell me something", "tell me about", "anything interesting",
+    "how are we doing", "how is business", "how’s business", "hows business",
+    "what do you know", "where do we stand", "status", "performance summary",
+    "company summary", "quick recap", "recap",
+]
+# short/very generic small talk
+SMALLTALK_PHRASES = [
+    "what's up", "whats up", "sup", "yo",
+    "how are you", "how are u", "how r u",
+]
+# words that make a very short ask (e.g. "any update") an overview request
+SHORT_OVERVIEW_WORDS = ["summary", "overview", "status", "update"]
+# words that ask for a chart
+VISUALIZATION_KEYWORDS = ["show", "visualize", "visualise", "plot", "graph", "chart", "draw", "diagram"]
+
+
+def _alternation(phrases: List[str]) -> str:
+    # Longest first so a phrase isn't shadowed by its own prefix
+    return "|".join(re.escape(p) for p in sorted(phrases, key=len, reverse=True))
+
+
+# All intent phrases in one pattern, scanned once per question; the named group
+# of each match says which list it came from
+_INTENT_RE = re.compile(
+    rf"(?P<greeting>^(?:{_alternation(GREETING_KEYWORDS)})(?= |$))"
+    rf"|(?P<overview>{_alternation(OVERVIEW_PHRASES + SMALLTALK_PHRASES)})"
+    rf"|(?P<short_overview>{_alternation(SHORT_OVERVIEW_WORDS)})"
+)
+# Matched anywhere in the lowercased question, as plain substrings
+_VISUALIZATION_RE = re.compile(_alternation(VISUALIZATION_KEYWORDS))
+
+
+def _classify_intent(text: str) -> Tuple[bool, bool]:
     """
-    Detect vague/overview/smalltalk questions where we want a quick summary,
+    Returns (is_greeting, is_smalltalk_or_overview) for a user question.
+    Overview/small talk are vague questions where we want a quick summary,
     not a full LLM analysis.
     """
     normalized = _normalize(text)
-    # phrases that usually mean "give me a quick overview"
-    overview_phrases = [
-        "overview", "high level", "highlevel", "summary", "quick summary",
-        "tell me something", "tell me about", "anything interesting",
-        "how are we doing", "how is business", "how’s business", "hows business",
-        "what do you know", "where do we stand", "status", "performance summary",
-        "company summary", "quick recap", "recap",
-    ]
-    # short/very generic small talk
-    smalltalk_phrases = [
-        "what's up", "whats up", "sup", "yo",
-        "how are you", "how are u", "how r u",
-    ]
-    # quick heuristic: either it contains one of these phrases, or it's very short and generic
-    if any(phrase in normalized for phrase in overview_phrases + smalltalk_phrases):
-        return True
-    # also treat very short generic asks like "tell me more" as overview
-    if len(normalized.split()) <= 4 and any(w in normalized for w in ["summary", "overview", "status", "update"]):
-        return True
-    return False
+    groups = {m.lastgroup for m in _INTENT_RE.finditer(normalized)}
+    n_words = len(normalized.split())
+    is_greeting = "greeting" in groups and n_words <= 5
+    # either it contains one of the phrases, or it's very short and generic
+    is_overview = "overview" in groups or ("short_overview" in groups and n_words <= 4)
+    return is_greeting, is_overview
 
 def _fmt_pct(x: float) -> str:
     return f"{x:.1f}%"
@@ -117,9 +184,31 @@ def _safe_ratio(n: float, d: float) -> float | None:
         pass
     return None
 
-def _build_quick_overview(company_name: str, years: list[int], metrics: dict, role: str) -> str:
+def _metric_series(
+    metrics: Dict[str, Dict[int, float]], metric_names: List[str], years: List[int]
+) -> Dict[str, List[float | None]]:
+    """
+    Align {metric_name: {year: value}} to the sorted `years`: one list per metric
+    name with None for missing values. Filled as one (metric x year) grid in a
+    single pass over the fetched cells.
+    """
+    column = {y: j for j, y in enumerate(years)}
+    grid = np.full((len(metric_names), len(years)), np.nan)
+    for i, metric_name in enumerate(metric_names):
+        for y, value in metrics.get(metric_name, {}).items():
+            if value is not None:
+                grid[i, column[y]] = value
+    return {
+        metric_name: [None if v != v else v for v in row]  # NaN -> None
+        for metric_name, row in zip(metric_names, grid.tolist())
+    }
+
+def _build_quick_overview(
+    company_name: str, years: list[int], series: Dict[str, List[float | None]], role: str
+) -> str:
     """
     Make a tight, role-aware summary using whatever we have (revenue & net_profit).
+    `series` is aligned with the sorted years (see _metric_series).
     Avoids any LLM call for speed.
     """
     if not years:
@@ -129,16 +218,16 @@ def _build_quick_overview(company_name: str, years: list[int], metrics: dict, ro
         )
 
     years_sorted = sorted(years)
-    # Pull series (may have gaps)
-    rev_series = [metrics.get("revenue", {}).get(y) for y in years_sorted]
-    pat_series = [metrics.get("net_profit", {}).get(y) for y in years_sorted]
+    # Series may have gaps
+    rev_series = series.get("revenue") or [None] * len(years_sorted)
+    pat_series = series.get("net_profit") or [None] * len(years_sorted)
 
     # Compute basics
     first_rev = next((v for v in rev_series if v is not None), None)
-    last_rev = next((rev_series[-i] for i in range(1, len(rev_series) + 1) if rev_series[-i] is not None), None)
+    last_rev = next((v for v in reversed(rev_series) if v is not None), None)
 
     first_pat = next((v for v in pat_series if v is not None), None)
-    last_pat = next((pat_series[-i] for i in range(1, len(pat_series) + 1) if pat_series[-i] is not None), None)
+    last_pat = next((v for v in reversed(pat_series) if v is not None), None)
 
     # YoY (last vs prev)
     yoy_rev = None
@@ -225,36 +314,193 @@ def _build_quick_overview(company_name: str, years: list[int], metrics: dict, ro
     return "\n".join(lines)
 
 
+# Answer prompts, assembled once at import: the system prompt per role is a
+# dict lookup, and the user prompt a single %-substitution into a fixed template
+ANSWER_SYSTEM_PROMPT = (
+    "You are a financial analyst assistant. You answer questions about a company's performance "
+    "STRICTLY based on the following:\n\n"
+    "1. Structured financial metrics provided to you (revenues, net profits, assets, liabilities, by year).\n"
+    "2. Text excerpts taken directly from the company's official balance sheet / annual report PDF.\n\n"
+    "Important context about annual reports:\n"
+    "* Annual reports typically contain multiple sections: Management Discussion and Analysis (MD&A), "
+    "Financial Statements, Notes to Accounts, and Auditor's Reports.\n"
+    "* Management Discussion and Analysis (MD&A) sections contain explanations, reasons, strategies, "
+    "risks, and management's perspective on performance changes.\n"
+    "* Financial Statements contain the actual numbers (revenues, profits, assets, etc.).\n"
+    "* Auditor's Reports contain audit opinions and procedures, but NOT management's explanations.\n\n"
+    "Rules:\n"
+    "* Use the metrics when answering numeric and trend questions.\n"
+    "* Use the text excerpts for qualitative, descriptive, or explanatory questions.\n"
+    "* For questions about 'reasons', 'explanations', 'why', 'factors', or 'management's perspective', "
+    "look for content from Management Discussion sections, not just financial statements or auditor reports.\n"
+    "* If the text excerpts contain Management Discussion content, use it to answer management-related questions.\n"
+    "* If the answer is not clearly supported by either the metrics or the excerpts, say you do NOT have that information in this document.\n"
+    "* Do NOT invent numbers or facts that are not in the provided context.\n"
+    "* Do NOT use external internet or prior knowledge; only rely on this document."
+)
+
+_ROLE_SYSTEM_PROMPTS = {
+    "ceo": ANSWER_SYSTEM_PROMPT + (
+        "\n\nThe user's role is: CEO/top management. Focus on high-level insights, key risks, and implications."
+    ),
+    "analyst": ANSWER_SYSTEM_PROMPT + (
+        "\n\nThe user's role is: Analyst. You can include more detailed breakdowns and commentary."
+    ),
+    "default": ANSWER_SYSTEM_PROMPT + (
+        "\n\nThe user's role is: Senior management. Provide an executive summary with some key numbers."
+    ),
+}
+
+# Fields: company, fiscal info, role, metrics block, RAG block, question
+ANSWER_USER_PROMPT_TEMPLATE = """Company: %s%s
+Role: %s
+
+%s%sBased ONLY on the above metrics and text excerpts, answer the user's question.
+
+User's question: %s
+
+Important: If the question asks about something not clearly mentioned in either the metrics or text excerpts above, 
+say "I don't have that information from this document." Do not make up facts or numbers.
+"""
+
+
+def _system_prompt_for_role(role: str) -> str:
+    rl = role.lower()
+    return _ROLE_SYSTEM_PROMPTS["ceo" if "ceo" in rl else "analyst" if "analyst" in rl else "default"]
+
+
+def _metrics_context(
+    years: List[int], metrics: Dict[str, Dict[int, float]], metric_names: List[str]
+) -> Tuple[List[int], Dict[str, List[float | None]], str, Dict[int, Dict[str, float]]]:
+    """
+    Everything chat_query derives from the fetched metrics:
+    (sorted years, series aligned with them, data context text for the prompt,
+    {year: {metric_name: value}} for the chart planner).
+    """
+    # Values aligned with the sorted years, built once and shared by the data
+    # context, the chart planner input and the quick overview
+    years = sorted(years)
+    series = _metric_series(metrics, metric_names, years)
+    
+    # Build data context string with all available metrics
+    if years:
+        data_lines = []
+        for j, y in enumerate(years):
+            parts = [f"FY {y}:"]
+            parts.extend(
+                f"{metric_name}={values[j]}"
+                for metric_name, values in series.items()
+                if values[j] is not None
+            )
+            if len(parts) > 1:  # Only add if we have at least one metric
+                data_lines.append(" ".join(parts))
+        data_context = "\n".join(data_lines) if data_lines else "No financial data available."
+    else:
+        data_context = "No financial data available."
+    
+    # ---- Build metrics_by_year dict for chart planner ----
+    metrics_by_year: Dict[int, Dict[str, float]] = {}
+    for j, y in enumerate(years):
+        year_metrics = {
+            metric_name: values[j] for metric_name, values in series.items() if values[j] is not None
+        }
+        if year_metrics:
+            metrics_by_year[y] = year_metrics
+    return years, series, data_context, metrics_by_year
+
+
+def _chart_from_plan(
+    plan: Dict[str, Any], metrics_by_year: Dict[int, Dict[str, float]]
+) -> ChartData | None:
+    """
+    Build the response chart for a planner result, or None if the plan wants no
+    chart or it can't be built (the answer is still returned without one).
+    """
+    if not plan.get("wants_chart"):
+        return None
+    try:
+        chart_data_dict = build_chart_data_from_plan(plan, metrics_by_year)
+        if not chart_data_dict:
+            return None
+        return ChartData(
+            chart_type=chart_data_dict["chart_type"],
+            years=chart_data_dict["years"],
+            series=[ChartSeries(**s) for s in chart_data_dict["series"]],
+        )
+    except Exception as e:
+        logger.warning("Error building chart data: %s", e)
+        return None
+
+
+def _greeting_response(company_name: str, fiscal_year: str | None) -> ChatResponse:
+    greeting_answer = (
+        f"Hi! I'm your financial copilot for {company_name}. "
+        "You can ask me about revenue, profit, assets, liabilities, trends, "
+        "or ratios based on the uploaded balance sheet document."
+    )
+    if fiscal_year:
+        greeting_answer += f" This document covers {fiscal_year}."
+    return ChatResponse(answer=greeting_answer, chart_data=None)
+
+
 @router.post("/query", response_model=ChatResponse)
-def chat_query(payload: ChatRequest, db: Session = Depends(get_db)):
+async def chat_query(payload: ChatRequest, db: Session = Depends(get_db)):
+    # Get the user's latest message; its intent decides how much context is loaded
+    user_question = payload.messages[-1].content if payload.messages else ""
+    is_greeting, is_overview = _classify_intent(user_question)
+    
+    # ---- Detect visualization intent ----
+    wants_visualization = _VISUALIZATION_RE.search(user_question.lower()) is not None
+    
     # Determine context: document_id (preferred) or company_code (legacy)
     company_name = None
     fiscal_year = None
-    years = []
-    metrics = {}
+    overview_key = None
     
+    # The sync DB reads below run in a worker thread, like retrieval, so a
+    # chat turn never blocks the event loop on SQLite
     if payload.document_id:
         # Document-based context (uploaded PDF)
-        doc = db.query(Document).filter(Document.id == payload.document_id).first()
+        doc = await asyncio.to_thread(_get_document, db, payload.document_id)
         if not doc:
             raise HTTPException(status_code=404, detail="Document not found")
         
         company_name = doc.company_name or "Unknown Company"
         fiscal_year = doc.fiscal_year
+        # A greeting only needs the document's name and year: no metrics, no RAG
+        if is_greeting:
+            return _greeting_response(company_name, fiscal_year)
+        # A parsed document's overview text only depends on its metrics and the role
+        if is_overview and not wants_visualization and doc.processed_at is not None:
+            overview_key = (doc.id, "overview", payload.role.lower())
+            overview = metrics_cache.get(overview_key)
+            if overview is not None:
+                return ChatResponse(answer=overview, chart_data=None)
         
         # Get all available metrics from the document
         metric_names = ["revenue", "net_profit", "total_assets", "total_liabilities"]
-        years, metrics = get_metrics_for_document(db, doc.id, metric_names, n=10)
+        # Parsed documents' metrics don't change until a re-parse invalidates
+        # them, so their derived context is built once; it is shared and only
+        # read below
+        context_key = (doc.id, tuple(metric_names), 10)
+        context = metrics_cache.get(context_key) if doc.processed_at is not None else None
+        if context is None:
+            years, metrics = await asyncio.to_thread(
+                get_metrics_for_document, db, doc.id, metric_names, n=10
+            )
+            context = _metrics_context(years, metrics, metric_names)
+            if doc.processed_at is not None:
+                metrics_cache.put(context_key, context)
     
     elif payload.company_code:
         # Legacy company-based context (seeded data)
-        company = db.query(Company).filter(Company.code == payload.company_code).first()
-        if not company:
-            raise HTTPException(status_code=404, detail="Company not found")
-        
-        company_name = company.name
         metric_names = ["revenue", "net_profit"]
-        years, metrics = get_last_n_years_metrics(db, company.id, metric_names, n=3)
+        company_name, years, metrics = await asyncio.to_thread(
+            get_last_n_years_metrics, db, payload.company_code, metric_names, n=3
+        )
+        if company_name is None:
+            raise HTTPException(status_code=404, detail="Company not found")
+        context = _metrics_context(years, metrics, metric_names)
     
     else:
         raise HTTPException(
@@ -262,80 +508,37 @@ def chat_query(payload: ChatRequest, db: Session = Depends(get_db)):
             detail="Either document_id or company_code must be provided"
         )
     
-    # Build data context string with all available metrics
-    if years:
-        data_lines = []
-        for y in sorted(years):
-            parts = [f"FY {y}:"]
-            if "revenue" in metrics and metrics["revenue"].get(y) is not None:
-                parts.append(f"revenue={metrics['revenue'].get(y)}")
-            if "net_profit" in metrics and metrics["net_profit"].get(y) is not None:
-                parts.append(f"net_profit={metrics['net_profit'].get(y)}")
-            if "total_assets" in metrics and metrics["total_assets"].get(y) is not None:
-                parts.append(f"total_assets={metrics['total_assets'].get(y)}")
-            if "total_liabilities" in metrics and metrics["total_liabilities"].get(y) is not None:
-                parts.append(f"total_liabilities={metrics['total_liabilities'].get(y)}")
-            if len(parts) > 1:  # Only add if we have at least one metric
-                data_lines.append(" ".join(parts))
-        data_context = "\n".join(data_lines) if data_lines else "No financial data available."
-    else:
-        data_context = "No financial data available."
-    
-    # Get the user's latest message
-    user_question = payload.messages[-1].content if payload.messages else ""
-    
-    # ---- Detect visualization intent ----
-    q_lower = user_question.lower()
-    wants_visualization = any(
-        kw in q_lower
-        for kw in ["show", "visualize", "visualise", "plot", "graph", "chart", "draw", "diagram"]
-    )
-    
-    # ---- Build metrics_by_year dict for chart planner ----
-    metrics_by_year: Dict[int, Dict[str, float]] = {}
-    if years:
-        for y in years:
-            metrics_by_year[y] = {}
-            for metric_name in ["revenue", "net_profit", "total_assets", "total_liabilities"]:
-                if metric_name in metrics and metrics[metric_name].get(y) is not None:
-                    metrics_by_year[y][metric_name] = metrics[metric_name][y]
+    years, series, data_context, metrics_by_year = context
     
     # ---- Greetings ----
-    if _is_greeting(user_question):
-        greeting_answer = (
-            f"Hi! I'm your financial copilot for {company_name}. "
-            "You can ask me about revenue, profit, assets, liabilities, trends, "
-            "or ratios based on the uploaded balance sheet document."
-        )
-        if fiscal_year:
-            greeting_answer += f" This document covers {fiscal_year}."
-        return ChatResponse(answer=greeting_answer, chart_data=None)
+    if is_greeting:
+        return _greeting_response(company_name, fiscal_year)
     
     # ---- Vague/overview -> quick summary without LLM ----
-    if _is_smalltalk_or_overview(user_question):
-        overview = _build_quick_overview(company_name, years, metrics, payload.role)
+    if is_overview:
+        overview = _build_quick_overview(company_name, years, series, payload.role)
+        if overview_key is not None:
+            metrics_cache.put(overview_key, overview)
         # Only show chart if user explicitly asked for visualization
         chart_data = None
         if wants_visualization and metrics_by_year:
-            plan = plan_chart_config(user_question, metrics_by_year)
-            if plan.get("wants_chart"):
-                chart_data_dict = build_chart_data_from_plan(plan, metrics_by_year)
-                if chart_data_dict:
-                    # Convert dict to ChartData model
-                    from app.schemas import ChartData, ChartSeries
-                    chart_data = ChartData(
-                        chart_type=chart_data_dict["chart_type"],
-                        years=chart_data_dict["years"],
-                        series=[ChartSeries(**s) for s in chart_data_dict["series"]]
-                    )
+            plan = await aplan_chart_config(user_question, metrics_by_year)
+            chart_data = _chart_from_plan(plan, metrics_by_year)
         return ChatResponse(answer=overview, chart_data=chart_data)
     
+    # The chart planner only needs the question and the metrics, so it runs
+    # while the chunks are retrieved and the answer is generated
+    chart_task = None
+    if wants_visualization and metrics_by_year:
+        chart_task = asyncio.create_task(aplan_chart_config(user_question, metrics_by_year))
+    
     # ---- RAG: Retrieve relevant text chunks (only for document-based queries) ----
     rag_chunks = []
     text_context = ""
     if payload.document_id:
         try:
-            rag_chunks = retrieve_relevant_chunks(
+            rag_chunks = await asyncio.to_thread(
+                retrieve_relevant_chunks,
                 db=db,
                 document_id=payload.document_id,
                 question=user_question,
@@ -347,47 +550,10 @@ def chat_query(payload: ChatRequest, db: Session = Depends(get_db)):
                 text_context = joined[:6000] if len(joined) > 6000 else joined
         except Exception as e:
             # Log but continue - RAG is optional, metrics still work
-            import logging
-            logger = logging.getLogger(__name__)
             logger.warning("RAG retrieval failed for document %s: %s", payload.document_id, e)
     
     # ---- System prompt tuned by role ----
-    system_prompt = (
-        "You are a financial analyst assistant. You answer questions about a company's performance "
-        "STRICTLY based on the following:\n\n"
-        "1. Structured financial metrics provided to you (revenues, net profits, assets, liabilities, by year).\n"
-        "2. Text excerpts taken directly from the company's official balance sheet / annual report PDF.\n\n"
-        "Important context about annual reports:\n"
-        "* Annual reports typically contain multiple sections: Management Discussion and Analysis (MD&A), "
-        "Financial Statements, Notes to Accounts, and Auditor's Reports.\n"
-        "* Management Discussion and Analysis (MD&A) sections contain explanations, reasons, strategies, "
-        "risks, and management's perspective on performance changes.\n"
-        "* Financial Statements contain the actual numbers (revenues, profits, assets, etc.).\n"
-        "* Auditor's Reports contain audit opinions and procedures, but NOT management's explanations.\n\n"
-        "Rules:\n"
-        "* Use the metrics when answering numeric and trend questions.\n"
-        "* Use the text excerpts for qualitative, descriptive, or explanatory questions.\n"
-        "* For questions about 'reasons', 'explanations', 'why', 'factors', or 'management's perspective', "
-        "look for content from Management Discussion sections, not just financial statements or auditor reports.\n"
-        "* If the text excerpts contain Management Discussion content, use it to answer management-related questions.\n"
-        "* If the answer is not clearly supported by either the metrics or the excerpts, say you do NOT have that information in this document.\n"
-        "* Do NOT invent numbers or facts that are not in the provided context.\n"
-        "* Do NOT use external internet or prior knowledge; only rely on this document."
-    )
-    
-    rl = payload.role.lower()
-    if "ceo" in rl:
-        system_prompt += (
-            "\n\nThe user's role is: CEO/top management. Focus on high-level insights, key risks, and implications."
-        )
-    elif "analyst" in rl:
-        system_prompt += (
-            "\n\nThe user's role is: Analyst. You can include more detailed breakdowns and commentary."
-        )
-    else:
-        system_prompt += (
-            "\n\nThe user's role is: Senior management. Provide an executive summary with some key numbers."
-        )
+    system_prompt = _system_prompt_for_role(payload.role)
     
     # Compose final user prompt for Gemini
     fiscal_info = f" (Fiscal Year: {fiscal_year})" if fiscal_year else ""
@@ -405,91 +571,20 @@ def chat_query(payload: ChatRequest, db: Session = Depends(get_db)):
             f"{text_context}\n\n"
         )
     
-    full_user_prompt = f"""Company: {company_name}{fiscal_info}
-Role: {payload.role}
-
-{metrics_block}{rag_block}Based ONLY on the above metrics and text excerpts, answer the user's question.
-
-User's question: {user_question}
-
-Important: If the question asks about something not clearly mentioned in either the metrics or text excerpts above, 
-say "I don't have that information from this document." Do not make up facts or numbers.
-"""
+    full_user_prompt = ANSWER_USER_PROMPT_TEMPLATE % (
+        company_name, fiscal_info, payload.role, metrics_block, rag_block, user_question
+    )
     
-    llm_answer = call_llm(system_prompt, full_user_prompt)
+    try:
+        llm_answer = await acall_llm(system_prompt, full_user_prompt)
+    except BaseException:
+        if chart_task is not None:
+            chart_task.cancel()
+        raise
     
     # Build chart_data only if user explicitly asked for visualization
     chart_data = None
-    if wants_visualization and metrics_by_year:
-        try:
-            plan = plan_chart_config(user_question, metrics_by_year)
-            if plan.get("wants_chart"):
-                chart_data_dict = build_chart_data_from_plan(plan, metrics_by_year)
-                if chart_data_dict:
-                    # Convert dict to ChartData model
-                    from app.schemas import ChartData, ChartSeries
-                    chart_data = ChartData(
-                        chart_type=chart_data_dict["chart_type"],
-                        years=chart_data_dict["years"],
-                        series=[ChartSeries(**s) for s in chart_data_dict["series"]]
-                    )
-        except Exception as e:
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.warning(f"Error building chart data: {e}")
-            # Continue without chart_data - chat still works
+    if chart_task is not None:
+        chart_data = _chart_from_plan(await chart_task, metrics_by_year)
     
     return ChatResponse(answer=llm_answer, chart_data=chart_data)
-
-
-def _build_chart_data(years: List[int], metrics: Dict[str, Dict[int, float]]) -> ChartData | None:
-    """
-    Build ChartData from years and metrics dict.
-    Includes all available metrics: revenue, net_profit, total_assets, total_liabilities.
-    """
-    if not years:
-        return None
-    
-    sorted_years = sorted(years)
-    series = []
-    
-    # Add revenue if available
-    if "revenue" in metrics and metrics["revenue"]:
-        series.append(
-            ChartSeries(
-                label="Revenue",
-                values=[metrics["revenue"].get(y, 0.0) for y in sorted_years],
-            )
-        )
-    
-    # Add net_profit if available
-    if "net_profit" in metrics and metrics["net_profit"]:
-        series.append(
-            ChartSeries(
-                label="Net Profit",
-                values=[metrics["net_profit"].get(y, 0.0) for y in sorted_years],
-            )
-        )
-    
-    # Add total_assets if available
-    if "total_assets" in metrics and metrics["total_assets"]:
-        series.append(
-            ChartSeries(
-                label="Total Assets",
-                values=[metrics["total_assets"].get(y, 0.0) for y in sorted_years],
-            )
-        )
-    
-    # Add total_liabilities if available
-    if "total_liabilities" in metrics and metrics["total_liabilities"]:
-        series.append(
-            ChartSeries(
-                label="Total Liabilities",
-                values=[metrics["total_liabilities"].get(y, 0.0) for y in sorted_years],
-            )
-        )
-    
-    if not series:
-        return None
-    
-    return ChartData(years=sorted_years, series=series)
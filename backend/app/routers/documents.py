@@ -1,10 +1,11 @@
 from fastapi import APIRouter, Depends
+from sqlalchemy import and_, case, func
 from sqlalchemy.orm import Session
 from typing import Optional
 
 from app.database import get_db
 from app.models import Document, FinancialMetric
-from app.schemas import DocumentSummary, DocumentListResponse
+from app.schemas import DocumentListResponse
 
 router = APIRouter()
 
@@ -19,7 +20,50 @@ def list_documents(
     Only includes documents where is_financial_report == True.
     Optionally filter by company_name.
     """
-    query = db.query(Document).filter(Document.is_financial_report == True)
+    # Latest year per document, and that year's revenue / net profit pivoted
+    # into one row per document, so only the summary values leave the DB
+    latest = (
+        db.query(FinancialMetric.document_id, func.max(FinancialMetric.year).label("year"))
+        .filter(FinancialMetric.year.isnot(None))
+        .group_by(FinancialMetric.document_id)
+        .subquery()
+    )
+    latest_values = (
+        db.query(
+            FinancialMetric.document_id,
+            latest.c.year,
+            func.max(
+                case((FinancialMetric.metric_name == "revenue", FinancialMetric.value))
+            ).label("revenue"),
+            func.max(
+                case((FinancialMetric.metric_name == "net_profit", FinancialMetric.value))
+            ).label("net_profit"),
+        )
+        .join(
+            latest,
+            and_(
+                latest.c.document_id == FinancialMetric.document_id,
+                latest.c.year == FinancialMetric.year,
+            ),
+        )
+        .group_by(FinancialMetric.document_id, latest.c.year)
+        .subquery()
+    )
+    query = (
+        db.query(
+            Document.id,
+            Document.company_name,
+            Document.fiscal_year,
+            Document.filename,
+            Document.created_at,
+            Document.parse_status,
+            latest_values.c.year.label("latest_year"),
+            latest_values.c.revenue.label("latest_revenue"),
+            latest_values.c.net_profit.label("latest_net_profit"),
+        )
+        .outerjoin(latest_values, latest_values.c.document_id == Document.id)
+        .filter(Document.is_financial_report == True)
+    )
     
     if company_name:
         query = query.filter(Document.company_name == company_name)
@@ -28,53 +72,11 @@ def list_documents(
     # Note: SQLite treats NULL as smaller than any value, so NULLs will appear last
     # Since we set default values in migration, all existing rows should have created_at
     try:
-        docs = query.order_by(Document.created_at.desc()).all()
+        rows = query.order_by(Document.created_at.desc()).all()
     except Exception:
         # Fallback: order by id if created_at causes issues
-        docs = query.order_by(Document.id.desc()).all()
-    
-    summaries: list[DocumentSummary] = []
-    
-    for doc in docs:
-        # Get all metrics for this document
-        metrics = (
-            db.query(FinancialMetric)
-            .filter(FinancialMetric.document_id == doc.id)
-            .all()
-        )
-        
-        # Group metrics by year
-        by_year: dict[int, dict[str, float]] = {}
-        for m in metrics:
-            year = m.year
-            if year is None:
-                continue
-            if year not in by_year:
-                by_year[year] = {}
-            by_year[year][m.metric_name] = m.value
-        
-        # Find latest year and its metrics
-        if by_year:
-            latest_year = max(by_year.keys())
-            latest_revenue = by_year[latest_year].get("revenue")
-            latest_net_profit = by_year[latest_year].get("net_profit")
-        else:
-            latest_year = None
-            latest_revenue = None
-            latest_net_profit = None
-        
-        summaries.append(
-            DocumentSummary(
-                id=doc.id,
-                company_name=doc.company_name,
-                fiscal_year=doc.fiscal_year,
-                filename=doc.filename,
-                created_at=doc.created_at,
-                latest_year=latest_year,
-                latest_revenue=latest_revenue,
-                latest_net_profit=latest_net_profit,
-            )
-        )
+        rows = query.order_by(Document.id.desc()).all()
     
-    return DocumentListResponse(documents=summaries)
+    # The whole list is validated in one call rather than one model per row
+    return DocumentListResponse.model_validate({"documents": [row._mapping for row in rows]})
 
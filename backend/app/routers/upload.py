@@ -1,29 +1,160 @@
+import asyncio
+import hashlib
+import logging
 import os
 import uuid
 from pathlib import Path
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Response, UploadFile, File
+from sqlalchemy import insert, update
 from sqlalchemy.orm import Session
 
-from app.database import get_db
+from app.database import SessionLocal, get_db
 from app.models import Document
 from app.schemas import UploadResponse
 from app.parsing import parse_pdf_and_populate_metrics, classify_pdf_as_financial
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # Directory to store uploaded PDFs
 UPLOAD_DIR = Path("data/uploads")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
+# Uploads are copied to disk in blocks of this size, never held in memory whole
+UPLOAD_COPY_BLOCK_SIZE = 1 << 20
 
-@router.post("/balance-sheet", response_model=UploadResponse)
+# Every PDF file starts with this
+PDF_MAGIC = b"%PDF-"
+
+
+def _save_upload(src, dest: Path) -> str:
+    """
+    Copy an uploaded file to dest block by block, returning its SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    # One reused buffer: each block is read into it, hashed and written from it
+    # without a new bytes object per block
+    buf = bytearray(UPLOAD_COPY_BLOCK_SIZE)
+    view = memoryview(buf)
+    with open(dest, "wb") as f:
+        while n := src.readinto(buf):
+            digest.update(view[:n])
+            f.write(view[:n])
+    return digest.hexdigest()
+
+
+def fail_interrupted_parses() -> int:
+    """
+    Mark documents left "pending" by a previous run as "failed", returning how
+    many there were. Processing runs in-process, so at startup nothing is still
+    working on them; uploading the file again retries it.
+    """
+    with SessionLocal() as db:
+        count = db.execute(
+            update(Document)
+            .where(Document.parse_status == "pending")
+            .values(parse_status="failed")
+        ).rowcount
+        db.commit()
+    return count
+
+
+def _find_document_by_hash(db: Session, content_hash: str):
+    """
+    The response fields of a pending or parsed document with this content hash, or None.
+    """
+    # Documents still being processed or parsed count; rejected ones don't, and
+    # failed ones don't either, so uploading the file again retries it
+    return db.query(
+        Document.id, Document.company_name, Document.fiscal_year, Document.parse_status
+    ).filter(
+        Document.content_hash == content_hash,
+        Document.parse_status.in_(("pending", "done"))
+    ).first()
+
+
+def _create_document(db: Session, filename: str, storage_path: str, content_hash: str) -> int:
+    """
+    Insert a pending Document row and commit it, returning its id.
+    """
+    # RETURNING hands back the new id in the same statement, no refresh needed
+    document_id = db.execute(
+        insert(Document)
+        .values(
+            filename=filename,
+            storage_path=storage_path,
+            content_hash=content_hash,  # Store hash for future deduplication
+            company_name=None,  # Will be filled by parser
+            fiscal_year=None,   # Will be filled by parser
+            company_code=None,
+            is_financial_report=None,
+            parse_status="pending",
+        )
+        .returning(Document.id)
+    ).scalar_one()
+    db.commit()
+    return document_id
+
+
+async def _process_in_background(document_id: int) -> None:
+    """
+    Classify and parse an uploaded document after its upload response has been
+    sent, in a session of its own (the request's session is closed by then), and
+    record the outcome in parse_status.
+    """
+    db = SessionLocal()
+
+    def commit_classification() -> None:
+        # Reload what parsing reads here too, rather than lazily on the event loop
+        db.commit()
+        db.refresh(doc)
+
+    try:
+        # Database work, PDF parsing and Gemini calls block, so they run off the event
+        # loop; SQLite may also wait here on the write lock held by another parse
+        doc = await asyncio.to_thread(db.get, Document, document_id)
+        if doc is None:
+            return
+        try:
+            is_financial, classification_reason = await asyncio.to_thread(
+                classify_pdf_as_financial, doc.storage_path, doc.content_hash
+            )
+            doc.is_financial_report = is_financial
+            doc.classification_reason = classification_reason
+            if is_financial:
+                await asyncio.to_thread(commit_classification)
+                company_name, fiscal_year = await parse_pdf_and_populate_metrics(doc, db)
+                doc.parse_status = "done"
+                logger.info(
+                    "Parsed document %s: company=%r, year=%r",
+                    document_id, company_name, fiscal_year,
+                )
+            else:
+                # Keep the row so the client can read why; the file isn't needed
+                doc.parse_status = "rejected"
+                Path(doc.storage_path).unlink(missing_ok=True)
+        except Exception as e:
+            # The document stays; parsing can be retried later if needed
+            logger.exception("Error parsing PDF for document %s: %s", document_id, e)
+            await asyncio.to_thread(db.rollback)
+            doc.parse_status = "failed"
+        await asyncio.to_thread(db.commit)
+    finally:
+        await asyncio.to_thread(db.close)
+
+
+@router.post("/balance-sheet", response_model=UploadResponse, status_code=202)
 async def upload_balance_sheet(
+    background_tasks: BackgroundTasks,
+    response: Response,
     file: UploadFile = File(...),
     db: Session = Depends(get_db)
 ):
     """
     Upload a PDF balance sheet/annual report.
-    Validates the file, saves it, creates a Document record, and parses it.
+    Validates the file, saves it and creates a Document record (202). Classification
+    and parsing run in the background; poll GET /upload/balance-sheet/{document_id}
+    until parse_status leaves "pending". A known file returns its document (200).
     """
     # Validate file type
     if not file.content_type or not file.content_type.startswith("application/pdf"):
@@ -39,27 +170,42 @@ async def upload_balance_sheet(
             detail="File must have .pdf extension"
         )
     
+    # Content type and extension are client-supplied; the header says whether it's a PDF
+    header = await file.read(len(PDF_MAGIC))
+    if header != PDF_MAGIC:
+        raise HTTPException(
+            status_code=400,
+            detail="File is not a valid PDF"
+        )
+    await file.seek(0)  # the header is part of the saved file and its hash
+    
     try:
-        # Read file content first to compute hash for deduplication
-        content = await file.read()
+        # Generate unique filename
+        file_uuid = str(uuid.uuid4())
+        file_extension = Path(file.filename).suffix
+        storage_filename = f"{file_uuid}{file_extension}"
+        # Fan out into subdirectories by the uuid's first two hex digits so no
+        # one directory grows huge; files saved flat before this stay where they are
+        shard_dir = UPLOAD_DIR / file_uuid[:2]
+        shard_dir.mkdir(exist_ok=True)
+        storage_path = shard_dir / storage_filename
         
-        # Compute content hash for deduplication
-        import hashlib
-        content_hash = hashlib.sha256(content).hexdigest()
+        # Save file, computing the content hash for deduplication on the way
+        content_hash = await asyncio.to_thread(_save_upload, file.file, storage_path)
         
         # Check if a document with the same content hash already exists
         # This prevents creating duplicate documents when the same PDF is uploaded multiple times
-        existing_doc = db.query(Document).filter(
-            Document.content_hash == content_hash,
-            Document.is_financial_report == True
-        ).first()
+        # (served by the content_hash index; only the response fields are loaded).
+        # Queries run in a worker thread, like chat_query's, so a busy SQLite doesn't
+        # block the event loop
+        existing_doc = await asyncio.to_thread(_find_document_by_hash, db, content_hash)
         
         if existing_doc:
             # Document with same content already exists - return existing document
             # This ensures consistent metrics (no re-parsing with potentially different LLM results)
-            db.refresh(existing_doc)
-            import logging
-            logger = logging.getLogger(__name__)
+            # and skips classification and parsing entirely
+            storage_path.unlink()
+            response.status_code = 200
             logger.info(
                 f"Duplicate document detected (hash: {content_hash[:8]}...). "
                 f"Returning existing document ID {existing_doc.id}"
@@ -67,81 +213,54 @@ async def upload_balance_sheet(
             return UploadResponse(
                 document_id=existing_doc.id,
                 company_name=existing_doc.company_name,
-                fiscal_year=existing_doc.fiscal_year
+                fiscal_year=existing_doc.fiscal_year,
+                parse_status=existing_doc.parse_status,
             )
         
-        # Generate unique filename
-        file_uuid = str(uuid.uuid4())
-        file_extension = Path(file.filename).suffix
-        storage_filename = f"{file_uuid}{file_extension}"
-        storage_path = UPLOAD_DIR / storage_filename
-        
-        # Save file
-        with open(storage_path, "wb") as f:
-            f.write(content)
-        
         # Get absolute path for storage in DB
         absolute_path = str(storage_path.resolve())
         
-        # Classify PDF as financial or non-financial BEFORE creating DB record
-        is_financial, classification_reason = classify_pdf_as_financial(absolute_path)
-        
-        # If not a financial document, reject with 400 error and clean up file
-        if not is_financial:
-            if storage_path.exists():
-                storage_path.unlink()
-            raise HTTPException(
-                status_code=400,
-                detail=f"Uploaded PDF is not a financial document. {classification_reason}"
-            )
-        
-        # Create Document record with classification (only for financial documents)
-        doc = Document(
-            filename=file.filename,
-            storage_path=absolute_path,
-            content_hash=content_hash,  # Store hash for future deduplication
-            company_name=None,  # Will be filled by parser
-            fiscal_year=None,   # Will be filled by parser
-            company_code=None,
-            is_financial_report=is_financial,
-            classification_reason=classification_reason
+        # Create Document record; classification fills in is_financial_report
+        document_id = await asyncio.to_thread(
+            _create_document, db, file.filename, absolute_path, content_hash
         )
         
-        db.add(doc)
-        db.commit()
-        db.refresh(doc)
-        
-        # Parse PDF and populate metrics (only for financial documents)
-        try:
-            parse_pdf_and_populate_metrics(doc, db)
-            # Refresh to get updated company_name and fiscal_year
-            db.refresh(doc)
-        except Exception as e:
-            # Log error but don't fail the upload
-            # The document is created, parsing can be retried later if needed
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.exception(f"Error parsing PDF: {e}")
+        # Classify the PDF and, for financial documents, parse it and populate
+        # metrics once the response is out
+        background_tasks.add_task(_process_in_background, document_id)
         
-        return UploadResponse(
-            document_id=doc.id,
-            company_name=doc.company_name,
-            fiscal_year=doc.fiscal_year
-        )
+        return UploadResponse(document_id=document_id, parse_status="pending")
     
-    except HTTPException:
-        # Re-raise HTTPException as-is (e.g., 400 for non-financial documents)
-        raise
     except Exception as e:
         # Clean up file if document creation failed
         if 'storage_path' in locals() and storage_path.exists():
             storage_path.unlink()
         
-        import logging
-        logger = logging.getLogger(__name__)
         logger.exception(f"Error uploading file: {e}")
         raise HTTPException(
             status_code=500,
             detail=f"Error processing upload: {str(e)}"
         )
 
+
+@router.get("/balance-sheet/{document_id}", response_model=UploadResponse)
+def get_upload_status(document_id: int, db: Session = Depends(get_db)):
+    """
+    Processing state of an uploaded document, polled after upload_balance_sheet.
+    """
+    doc = db.query(
+        Document.id,
+        Document.company_name,
+        Document.fiscal_year,
+        Document.parse_status,
+        Document.classification_reason,
+    ).filter(Document.id == document_id).first()
+    if not doc:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return UploadResponse(
+        document_id=doc.id,
+        company_name=doc.company_name,
+        fiscal_year=doc.fiscal_year,
+        parse_status=doc.parse_status,
+        rejection_reason=doc.classification_reason if doc.parse_status == "rejected" else None,
+    )
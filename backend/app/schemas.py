@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import List, Optional, Literal
 from datetime import datetime
 
@@ -26,6 +26,33 @@ class ChartData(BaseModel):
     series: List[ChartSeries]
 
 
+class ChartPlan(BaseModel):
+    """Chart planner output; also passed to Gemini as the response_schema."""
+    wants_chart: bool
+    chart_type: Literal["line", "bar", "pie", "none"]
+    x_axis: Literal["year", "metric"]
+    metrics: List[str]
+    aggregation: Literal["none", "latest_year"]
+
+
+class PnlYearMetrics(BaseModel):
+    year: int
+    revenue: Optional[float]
+    net_profit: Optional[float]
+
+
+class BalanceSheetYearMetrics(BaseModel):
+    year: int
+    total_assets: Optional[float]
+    total_liabilities: Optional[float]
+
+
+class FinancialsExtraction(BaseModel):
+    """Combined P&L + Balance Sheet extraction; passed to Gemini as the response_schema."""
+    pnl_metrics: List[PnlYearMetrics]
+    bs_metrics: List[BalanceSheetYearMetrics]
+
+
 class ChatResponse(BaseModel):
     answer: str
     chart_data: Optional[ChartData] = None
@@ -35,6 +62,8 @@ class UploadResponse(BaseModel):
     document_id: int
     company_name: Optional[str] = None
     fiscal_year: Optional[str] = None
+    parse_status: Optional[str] = None  # "pending" | "done" | "failed" | "rejected"
+    rejection_reason: Optional[str] = None  # why a "rejected" PDF isn't a financial document
 
 
 class DocumentSummary(BaseModel):
@@ -43,13 +72,16 @@ class DocumentSummary(BaseModel):
     fiscal_year: Optional[str] = None
     filename: str
     created_at: Optional[datetime] = None
+    parse_status: Optional[str] = None
     latest_year: Optional[int] = None
     latest_revenue: Optional[float] = None
     latest_net_profit: Optional[float] = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class DocumentListResponse(BaseModel):
+    # Only built when the documents route first needs it, not at import
+    model_config = ConfigDict(defer_build=True)
+
     documents: List[DocumentSummary]
@@ -0,0 +1,480 @@
+"""
+In-memory similarity index over document chunk embeddings.
+
+Each document's chunk vectors are L2-normalized and stacked into one N x D
+matrix with a parallel array of chunk ids, so scoring a query is a single BLAS
+mat-vec product instead of a per-chunk Python loop.
+
+The matrix is kept 8-bit quantized per dimension: codes[i, j] in 0..255 with
+row[j] ~= offset[j] + scale[j] * codes[i, j], where offset/scale come from the
+document's per-dimension min/max. That is 4x less memory (and disk) than
+float32, and because the query stays float32 the dot product folds the
+dequantization in: row . q = codes[i] . (scale * q) + offset . q.
+
+Each row also carries a bitmask of the chunk's retrieval keyword flags
+(DocumentChunk.has_mda / has_financial / has_auditor), stored as a parallel
+array, so keyword boosts are applied in the same pass as the similarity via a
+lookup table instead of per-chunk Python.
+
+Large documents are first narrowed with a 1-bit-per-dimension sign sketch:
+Hamming distance over packed bits (32x less data than float32) picks the
+candidate rows, and only those are scored against the 8-bit codes.
+
+Top-k search over many rows exits early per row: the leading dimensions are
+scored first, and rows that cannot reach the k-th best score even if their
+remaining dimensions were perfectly aligned with the query (bounded by the
+norm of each row's tail, kept alongside the codes) are dropped before the rest
+of the dot product.
+
+Each matrix is persisted as one document_embeddings row per document, so a
+cold load is a single read instead of decoding every chunk row. The per-chunk
+embeddings remain the source of truth: the index is rebuilt from them when the
+row is missing or stale.
+"""
+import logging
+import threading
+from typing import Mapping, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import LargeBinary, func, type_coerce
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.database import SessionLocal
+from app.models import DocumentChunk, DocumentEmbeddings, EmbeddingVector
+
+logger = logging.getLogger(__name__)
+
+# (chunk ids [N], uint8 codes [N, D], quantization params [2, D] = (offset, scale),
+#  keyword flag bitmasks [N], packed sign bits [N, ceil(D / 8)],
+#  norms of the dequantized rows past EARLY_EXIT_PREFIX_DIMS [N])
+_Entry = Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+# DocumentChunk flag columns; bit i of a row's flag mask is FLAG_COLUMNS[i]
+FLAG_COLUMNS = ("has_mda", "has_financial", "has_auditor")
+
+# Rows cast to float32 per step when scoring (256 x 768 floats = 768 KB, L2-sized)
+SCORE_BLOCK_ROWS = 256
+
+# Documents with more rows than this use the binary prefilter when asked for candidates
+BINARY_PREFILTER_MIN_ROWS = 4096
+# Candidates kept per requested result by search() when prefiltering
+RERANK_OVERSAMPLE = 4
+
+# Set bits per byte value, for the Hamming distance (np.bitwise_count needs NumPy 2)
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# search() scores this many leading dimensions before pruning rows by their bound...
+EARLY_EXIT_PREFIX_DIMS = 192
+# ...when at least this many candidate rows are left and the tails are small enough
+# for the bound to prune: mean |row tail| * |query tail| at most this. Embeddings
+# whose energy is spread evenly over the dimensions never qualify.
+EARLY_EXIT_MIN_ROWS = 1024
+EARLY_EXIT_MAX_TAIL_BOUND = 0.02
+# Margin on the bounds for float32 rounding, so pruning never drops a true top-k row
+EARLY_EXIT_SLACK = 1e-4
+
+# document_id -> entry
+_store: dict[int, _Entry] = {}
+_lock = threading.Lock()
+
+
+def _empty() -> _Entry:
+    return (
+        np.empty(0, dtype=np.int64),
+        np.empty((0, 0), dtype=np.uint8),
+        np.empty((2, 0), dtype=np.float32),
+        np.empty(0, dtype=np.uint8),
+        np.empty((0, 0), dtype=np.uint8),
+        np.empty(0, dtype=np.float32),
+    )
+
+
+def pack_flags(flags: Mapping[str, bool | None]) -> int:
+    """
+    Bitmask of a chunk's FLAG_COLUMNS values (missing or None counts as False).
+    """
+    return sum(1 << i for i, column in enumerate(FLAG_COLUMNS) if flags.get(column))
+
+
+def _boost_table(flag_boosts: Sequence[float]) -> np.ndarray:
+    """
+    Boost for every possible flag mask: table[mask] = sum of flag_boosts[i] for set bits i.
+    """
+    table = np.zeros(1 << len(FLAG_COLUMNS), dtype=np.float64)
+    for mask in range(len(table)):
+        for i, boost in enumerate(flag_boosts):
+            if mask & (1 << i):
+                table[mask] += boost
+    return table
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0  # zero vectors keep a similarity of 0
+    return matrix / norms
+
+
+def _quantize(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Per-dimension min/max quantization of a float matrix to uint8 codes.
+    Returns (codes, params) with params = [offset, scale].
+    """
+    lo = matrix.min(axis=0)
+    scale = (matrix.max(axis=0) - lo) / 255.0
+    scale[scale == 0] = 1.0  # constant dimension: every code is 0
+    codes = np.rint((matrix - lo) / scale).clip(0, 255).astype(np.uint8)
+    return codes, np.stack([lo, scale]).astype(np.float32)
+
+
+def _dequantize(codes: np.ndarray, params: np.ndarray) -> np.ndarray:
+    return params[0] + codes.astype(np.float32) * params[1]
+
+
+def _sign_bits(codes: np.ndarray, params: np.ndarray) -> np.ndarray:
+    """
+    Pack whether each dequantized component is positive, one bit per dimension.
+    """
+    return np.packbits(params[0] + codes.astype(np.float32) * params[1] > 0, axis=1)
+
+
+def _tail_norms(codes: np.ndarray, params: np.ndarray) -> np.ndarray:
+    """
+    L2 norm of each dequantized row past EARLY_EXIT_PREFIX_DIMS.
+    """
+    p = EARLY_EXIT_PREFIX_DIMS
+    tail = params[0, p:] + codes[:, p:].astype(np.float32) * params[1, p:]
+    return np.linalg.norm(tail, axis=1)
+
+
+def _derived(codes: np.ndarray, params: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Per-row arrays rebuilt from the codes on load rather than persisted
+    return _sign_bits(codes, params), _tail_norms(codes, params)
+
+
+def _codes_dot(codes: np.ndarray, w: np.ndarray) -> np.ndarray:
+    """
+    codes @ w for uint8 codes, casting SCORE_BLOCK_ROWS rows at a time into one
+    reused float32 buffer that stays in cache, instead of materializing a full
+    float32 copy of the matrix per query.
+    """
+    n = len(codes)
+    out = np.empty(n, dtype=np.float32)
+    buf = np.empty((min(SCORE_BLOCK_ROWS, n), codes.shape[1]), dtype=np.float32)
+    for start in range(0, n, SCORE_BLOCK_ROWS):
+        block = codes[start:start + SCORE_BLOCK_ROWS]
+        rows = buf[:len(block)]
+        rows[...] = block
+        np.dot(rows, w, out=out[start:start + len(block)])
+    return out
+
+
+def _save_to_db(document_id: int, entry: _Entry) -> None:
+    # A session of its own: callers' sessions (a request's, on the search path)
+    # are theirs to commit or roll back
+    ids, codes, params, flags = entry[:4]
+    with SessionLocal() as db:
+        try:
+            db.merge(
+                DocumentEmbeddings(
+                    document_id=document_id,
+                    dim=codes.shape[1],
+                    dtype=codes.dtype.str,
+                    chunk_ids=ids.astype("<i8").tobytes(),
+                    matrix=np.ascontiguousarray(codes).tobytes(),
+                    params=params.astype("<f4").tobytes(),
+                    flags=flags.astype(np.uint8).tobytes(),
+                )
+            )
+            db.commit()
+        except SQLAlchemyError as e:
+            db.rollback()
+            logger.warning("Could not store vector index row for document %s: %s", document_id, e)
+
+
+def _count_embedded_chunks(db: Session, document_id: int) -> int:
+    return (
+        db.query(func.count(DocumentChunk.id))
+        .filter(DocumentChunk.document_id == document_id, DocumentChunk.embedding.isnot(None))
+        .scalar()
+    )
+
+
+def _is_current(
+    db: Session, document_id: int, ids: np.ndarray, codes: np.ndarray, params: np.ndarray, flags: np.ndarray
+) -> bool:
+    # Guards against copies left over from a different database or an older ingest
+    return (
+        len(ids) == len(codes) == len(flags)
+        and params.shape == (2, codes.shape[1])
+        and len(ids) == _count_embedded_chunks(db, document_id)
+    )
+
+
+def _load_from_table(
+    db: Session, document_id: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None:
+    row = db.get(DocumentEmbeddings, document_id)
+    if row is None:
+        return None
+    try:
+        ids = np.frombuffer(row.chunk_ids, dtype="<i8")
+        codes = np.frombuffer(row.matrix, dtype=row.dtype).reshape(-1, row.dim)
+        params = np.frombuffer(row.params, dtype="<f4").reshape(2, -1)
+        flags = np.frombuffer(row.flags, dtype=np.uint8)
+    except (TypeError, ValueError) as e:
+        logger.warning("Ignoring unreadable vector index row for document %s: %s", document_id, e)
+        return None
+    if codes.dtype != np.uint8 or not _is_current(db, document_id, ids, codes, params, flags):
+        logger.info("Vector index row for document %s is stale, rebuilding", document_id)
+        return None
+    return ids, codes, params, flags
+
+
+def _load_from_db(db: Session, document_id: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Read the raw float16 BLOBs and decode them in one frombuffer call below,
+    # instead of one EmbeddingVector conversion per row
+    rows = (
+        db.query(
+            DocumentChunk.id,
+            type_coerce(DocumentChunk.embedding, LargeBinary),
+            *(getattr(DocumentChunk, column) for column in FLAG_COLUMNS),
+        )
+        .filter(DocumentChunk.document_id == document_id, DocumentChunk.embedding.isnot(None))
+        .order_by(DocumentChunk.id)
+        .all()
+    )
+    rows = [row for row in rows if row[1]]
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.uint8)
+
+    if any(not isinstance(row[1], bytes) for row in rows):
+        # Legacy JSON-encoded rows: decode through the column type
+        vectors = [EmbeddingVector().process_result_value(row[1], None) for row in rows]
+    else:
+        vectors = None
+
+    # Skip rows whose dimension doesn't match the document's majority (e.g. model change)
+    sizes = [len(v) for v in vectors] if vectors is not None else [len(row[1]) for row in rows]
+    size = max(set(sizes), key=sizes.count)
+    keep = [i for i, n in enumerate(sizes) if n == size]
+
+    ids = np.fromiter((rows[i][0] for i in keep), dtype=np.int64, count=len(keep))
+    flags = _row_flags(db, [rows[i] for i in keep])
+    if vectors is not None:
+        matrix = np.vstack([vectors[i] for i in keep]).astype(np.float32)
+    else:
+        packed = b"".join(rows[i][1] for i in keep)
+        matrix = np.frombuffer(packed, dtype=np.float16).reshape(len(keep), -1).astype(np.float32)
+    return ids, _normalize_rows(matrix), flags
+
+
+def _row_flags(db: Session, rows: list) -> np.ndarray:
+    """
+    Flag masks for (id, embedding, *FLAG_COLUMNS) rows. Chunks stored before the
+    flag columns existed (NULL) are flagged from their text.
+    """
+    from app.retrieval import chunk_keyword_flags  # retrieval imports this module
+
+    legacy_ids = [row[0] for row in rows if row[2] is None]
+    legacy = {}
+    if legacy_ids:
+        legacy = {
+            chunk_id: pack_flags(chunk_keyword_flags(text))
+            for chunk_id, text in db.query(DocumentChunk.id, DocumentChunk.text)
+            .filter(DocumentChunk.id.in_(legacy_ids))
+        }
+    return np.fromiter(
+        (
+            legacy.get(row[0], 0) if row[2] is None else pack_flags(dict(zip(FLAG_COLUMNS, row[2:])))
+            for row in rows
+        ),
+        dtype=np.uint8,
+        count=len(rows),
+    )
+
+
+def load(db: Session, document_id: int) -> _Entry:
+    """
+    Return (chunk_ids, codes, params, flags, sign_bits, tail_norms) for a document, loading it
+    into memory on first use from its document_embeddings row or (failing that)
+    the chunk rows. All are empty if nothing is embedded.
+    """
+    entry = _store.get(document_id)
+    if entry is not None:
+        return entry
+
+    stored = _load_from_table(db, document_id)
+    if stored is not None:
+        entry = (*stored, *_derived(stored[1], stored[2]))
+    else:
+        ids, matrix, flags = _load_from_db(db, document_id)
+        if len(ids):
+            codes, params = _quantize(matrix)
+            entry = (ids, codes, params, flags, *_derived(codes, params))
+            _save_to_db(document_id, entry)
+        else:
+            entry = _empty()
+
+    with _lock:
+        _store[document_id] = entry
+    return entry
+
+
+def add(
+    document_id: int,
+    ids: Sequence[int],
+    vectors: Sequence[Sequence[float]],
+    flags: Sequence[int],
+) -> None:
+    """
+    Append freshly embedded (and committed) chunks, with their pack_flags masks,
+    for a document and persist the updated matrix to the database. Existing rows are dequantized and requantized
+    together with the new ones, since the per-dimension ranges may widen.
+    """
+    if not len(ids):
+        return
+    new_ids = np.asarray(ids, dtype=np.int64)
+    new_matrix = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+    new_flags = np.asarray(flags, dtype=np.uint8)
+
+    with _lock:
+        entry = _store.get(document_id)
+        if entry is not None and len(entry[0]) and entry[1].shape[1] == new_matrix.shape[1]:
+            new_ids = np.concatenate([entry[0], new_ids])
+            new_matrix = np.vstack([_dequantize(entry[1], entry[2]), new_matrix])
+            new_flags = np.concatenate([entry[3], new_flags])
+        codes, params = _quantize(new_matrix)
+        entry = (new_ids, codes, params, new_flags, *_derived(codes, params))
+        _store[document_id] = entry
+    _save_to_db(document_id, entry)
+
+
+def invalidate(document_id: int) -> None:
+    """
+    Drop a document's matrix from memory (its document_embeddings row is caught
+    by the staleness check on the next load).
+    """
+    with _lock:
+        _store.pop(document_id, None)
+
+
+def _candidates(
+    entry: _Entry, q: np.ndarray, max_candidates: int | None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (ids, codes, flags, tail_norms) of the rows to score for unit query q: every
+    row, or for documents over BINARY_PREFILTER_MIN_ROWS rows, the max_candidates
+    rows nearest by sign-bit Hamming distance (ids ascending).
+    """
+    ids, codes, _, flags, bits, tail_norms = entry
+    if max_candidates is not None and len(ids) > max(BINARY_PREFILTER_MIN_ROWS, max_candidates):
+        hamming = _POPCOUNT[bits ^ np.packbits(q > 0)].sum(axis=1, dtype=np.int32)
+        rows = np.sort(np.argpartition(hamming, max_candidates - 1)[:max_candidates])
+        return ids[rows], codes[rows], flags[rows], tail_norms[rows]
+    return ids, codes, flags, tail_norms
+
+
+def scores(
+    db: Session,
+    document_id: int,
+    query_vec: Sequence[float],
+    max_candidates: int | None = None,
+    flag_boosts: Sequence[float] | None = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cosine similarity of query_vec against the embedded chunks of the document.
+    Returns (chunk_ids, scores); both empty if the document has no usable embeddings.
+
+    max_candidates: for documents over BINARY_PREFILTER_MIN_ROWS rows, only score
+      the max_candidates rows nearest by sign-bit Hamming distance (ids ascending).
+      None scores every row.
+    flag_boosts: score added per FLAG_COLUMNS flag set on a chunk (one value per
+      column). The scores are then float64.
+    """
+    entry = load(db, document_id)
+    ids, codes, params, flags = entry[:4]
+    q = np.asarray(query_vec, dtype=np.float32)
+    if not len(ids) or q.shape[0] != codes.shape[1]:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    norm = np.linalg.norm(q)
+    if norm == 0:
+        sims = np.zeros(len(ids), dtype=np.float32)
+    else:
+        q = q / norm
+        ids, codes, flags, _ = _candidates(entry, q, max_candidates)
+        offset, scale = params
+        sims = _codes_dot(codes, scale * q) + np.dot(offset, q)
+    if flag_boosts is not None:
+        sims = sims.astype(np.float64) + _boost_table(flag_boosts)[flags]
+    return ids, sims
+
+
+def _top_k(ids: np.ndarray, sims: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Best first; ties keep row order
+    if k < len(sims):
+        top = np.sort(np.argpartition(-sims, k - 1)[:k])
+    else:
+        top = np.arange(len(sims))
+    top = top[np.argsort(-sims[top], kind="stable")]
+    return ids[top], sims[top]
+
+
+def search(
+    db: Session,
+    document_id: int,
+    query_vec: Sequence[float],
+    k: int,
+    max_candidates: int | None = None,
+    flag_boosts: Sequence[float] | None = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Top-k chunk ids by cosine similarity (plus flag_boosts, as in scores), best
+    first, with their scores. Large documents are prefiltered to max_candidates
+    rows (default RERANK_OVERSAMPLE * k).
+
+    With at least EARLY_EXIT_MIN_ROWS candidates whose energy sits mostly in the
+    leading EARLY_EXIT_PREFIX_DIMS dimensions, rows are first scored on those; by
+    Cauchy-Schwarz the rest adds at most |row tail| * |query tail|, so rows whose
+    upper bound is below the k-th best lower bound can't make the top k and skip
+    the full dot product. The top k are the same as when scoring every candidate.
+    """
+    if max_candidates is None:
+        max_candidates = max(k, 1) * RERANK_OVERSAMPLE
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    entry = load(db, document_id)
+    ids, codes, params = entry[:3]
+    q = np.asarray(query_vec, dtype=np.float32)
+    p = EARLY_EXIT_PREFIX_DIMS
+    norm = np.linalg.norm(q)
+    if len(ids) and q.shape[0] == codes.shape[1] > p and norm > 0:
+        q = q / norm
+        ids, codes, flags, tail_norms = _candidates(entry, q, max_candidates)
+        offset, scale = params
+        w = scale * q
+        boosts = _boost_table(flag_boosts)[flags] if flag_boosts is not None else None
+        q_tail = np.linalg.norm(q[p:])
+        if (
+            len(ids) >= max(EARLY_EXIT_MIN_ROWS, 2 * k)
+            and tail_norms.mean() * q_tail <= EARLY_EXIT_MAX_TAIL_BOUND
+        ):
+            partial = _codes_dot(codes[:, :p], w[:p]) + np.dot(offset[:p], q[:p])
+            if boosts is not None:
+                partial = partial + boosts
+            slack = tail_norms * q_tail + EARLY_EXIT_SLACK
+            lower = partial - slack
+            threshold = np.partition(lower, len(lower) - k)[len(lower) - k]  # k-th best lower bound
+            keep = np.flatnonzero(partial + slack >= threshold)
+            ids, codes = ids[keep], codes[keep]
+            if boosts is not None:
+                boosts = boosts[keep]
+        sims = _codes_dot(codes, w) + np.dot(offset, q)
+        if boosts is not None:
+            sims = sims.astype(np.float64) + boosts
+        return _top_k(ids, sims, k)
+
+    # Nothing to score, or a zero query: same as scores()
+    ids, sims = scores(db, document_id, query_vec, max_candidates=max_candidates, flag_boosts=flag_boosts)
+    return _top_k(ids, sims, k)
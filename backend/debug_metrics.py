@@ -1,14 +1,26 @@
+from sqlalchemy import select
+
 from app.database import SessionLocal
 from app.models import FinancialMetric, Document
 
 db = SessionLocal()
 
-docs = db.query(Document).all()
+docs = db.execute(select(Document.id, Document.company_name, Document.fiscal_year))
 print("Documents:")
 for d in docs:
     print(f"- id={d.id}, name={d.company_name}, year={d.fiscal_year}")
 
-rows = db.query(FinancialMetric).all()
+# Plain column rows fetched in batches, so memory doesn't grow with the table
+rows = db.execute(
+    select(
+        FinancialMetric.id,
+        FinancialMetric.document_id,
+        FinancialMetric.company_id,
+        FinancialMetric.year,
+        FinancialMetric.metric_name,
+        FinancialMetric.value,
+    ).execution_options(yield_per=1000)
+)
 print("\nFinancial metrics:")
 for r in rows:
     print(
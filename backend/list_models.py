@@ -1,7 +1,24 @@
+import hashlib
+import time
+from pathlib import Path
+
 import google.generativeai as genai
+from app import jsonutil
 from app.config import settings
 
-genai.configure(api_key=settings.GEMINI_API_KEY)
+# The model list rarely changes; reuse it for a day instead of calling the API on every run.
+# Keyed by the API key's hash, since different keys can see different models.
+CACHE_TTL_SECONDS = 24 * 60 * 60
+key_hash = hashlib.sha256(settings.GEMINI_API_KEY.encode()).hexdigest()[:16]
+cache_path = Path(f"~/.cache/elimentary/models-{key_hash}.json").expanduser()
+
+if cache_path.exists() and time.time() - cache_path.stat().st_mtime < CACHE_TTL_SECONDS:
+    names = jsonutil.loads(cache_path.read_text())
+else:
+    genai.configure(api_key=settings.GEMINI_API_KEY)
+    names = [m.name for m in genai.list_models()]
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    cache_path.write_text(jsonutil.dumps(names))
 
-for m in genai.list_models():
-    print(m.name)
+for name in names:
+    print(name)
@@ -1,6 +1,7 @@
 """
-Migration script to add is_financial_report and classification_reason columns to documents table.
-This script safely adds the new columns if they don't already exist.
+Migration script that brings an existing SQLite database up to the current schema:
+columns added to documents and document_chunks, metric indexes and new tables.
+Every change is applied if missing, in a single transaction.
 """
 import sqlite3
 from pathlib import Path
@@ -8,7 +9,7 @@ from app.config import settings
 
 
 def migrate_database():
-    """Add new columns to documents table if they don't exist."""
+    """Add missing columns, indexes and tables."""
     # Extract database path from DATABASE_URL
     db_url = settings.DATABASE_URL
     if db_url.startswith("sqlite:///"):
@@ -27,90 +28,123 @@ def migrate_database():
     cursor = conn.cursor()
     
     try:
-        # Check if columns already exist
+        # Probe the current schema once, then apply every change in one script
         cursor.execute("PRAGMA table_info(documents)")
         columns = [row[1] for row in cursor.fetchall()]
+        cursor.execute("PRAGMA table_info(document_chunks)")
+        chunk_columns = [row[1] for row in cursor.fetchall()]  # empty if the table doesn't exist
         
-        # Add is_financial_report column if it doesn't exist
-        if "is_financial_report" not in columns:
-            print("Adding is_financial_report column...")
-            cursor.execute("ALTER TABLE documents ADD COLUMN is_financial_report BOOLEAN")
-            print("[OK] Added is_financial_report column")
-        else:
-            print("[OK] is_financial_report column already exists")
-        
-        # Add classification_reason column if it doesn't exist
-        if "classification_reason" not in columns:
-            print("Adding classification_reason column...")
-            cursor.execute("ALTER TABLE documents ADD COLUMN classification_reason TEXT")
-            print("[OK] Added classification_reason column")
-        else:
-            print("[OK] classification_reason column already exists")
+        stmts = []
         
-        # Add created_at column if it doesn't exist
-        if "created_at" not in columns:
-            print("Adding created_at column...")
-            cursor.execute("ALTER TABLE documents ADD COLUMN created_at DATETIME")
-            print("[OK] Added created_at column")
-        else:
-            print("[OK] created_at column already exists")
-        
-        # Add processed_at column if it doesn't exist
-        if "processed_at" not in columns:
-            print("Adding processed_at column...")
-            cursor.execute("ALTER TABLE documents ADD COLUMN processed_at DATETIME")
-            print("[OK] Added processed_at column")
-        else:
-            print("[OK] processed_at column already exists")
+        # Columns added to documents over time
+        document_columns = [
+            ("is_financial_report", "BOOLEAN"),
+            ("classification_reason", "TEXT"),
+            ("created_at", "DATETIME"),
+            ("processed_at", "DATETIME"),
+            ("content_hash", "TEXT"),
+            ("parse_status", "TEXT"),
+        ]
+        for column, column_type in document_columns:
+            if column not in columns:
+                stmts.append(f"ALTER TABLE documents ADD COLUMN {column} {column_type}")
+                print(f"Adding {column} column...")
+            else:
+                print(f"[OK] {column} column already exists")
         
-        # Add content_hash column if it doesn't exist (for deduplication)
         if "content_hash" not in columns:
-            print("Adding content_hash column...")
-            cursor.execute("ALTER TABLE documents ADD COLUMN content_hash TEXT")
-            # Create index for faster lookups
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents(content_hash)")
-            print("[OK] Added content_hash column and index")
-        else:
-            print("[OK] content_hash column already exists")
+            # Index for faster deduplication lookups
+            stmts.append("CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents(content_hash)")
+        
+        if "parse_status" not in columns:
+            # Documents from before background parsing
+            stmts.append("""
+                UPDATE documents
+                SET parse_status = CASE WHEN processed_at IS NOT NULL THEN 'done' ELSE 'failed' END
+            """)
         
         # Set default created_at for existing rows that have NULL
-        print("Setting default created_at for existing rows...")
-        cursor.execute("""
+        stmts.append("""
             UPDATE documents 
             SET created_at = datetime('now') 
             WHERE created_at IS NULL
         """)
-        updated_count = cursor.rowcount
-        if updated_count > 0:
-            print(f"[OK] Updated {updated_count} existing rows with default created_at")
-        else:
-            print("[OK] No rows needed updating")
         
-        # Check if document_chunks table exists, create if not
-        cursor.execute("""
-            SELECT name FROM sqlite_master 
-            WHERE type='table' AND name='document_chunks'
+        # Composite index for per-document metric lookups; the company lookups use
+        # the unique index below
+        stmts.append(
+            "CREATE INDEX IF NOT EXISTS ix_fm_doc_metric_year "
+            "ON financial_metrics(document_id, metric_name, year)"
+        )
+        # Indexes it and the unique index make redundant, each one a cost on every insert
+        for index in (
+            "ix_fm_doc_year_metric",
+            "ix_fm_co_metric_year",
+            "ix_financial_metrics_year",
+            "ix_financial_metrics_metric_name",
+        ):
+            stmts.append(f"DROP INDEX IF EXISTS {index}")
+        # Keep the first of any duplicate company metrics so the unique index can be built
+        stmts.append("""
+            DELETE FROM financial_metrics
+            WHERE company_id IS NOT NULL AND id NOT IN (
+                SELECT MIN(id) FROM financial_metrics
+                WHERE company_id IS NOT NULL
+                GROUP BY company_id, year, metric_name
+            )
         """)
-        table_exists = cursor.fetchone() is not None
+        stmts.append(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_fm_co_year_metric "
+            "ON financial_metrics(company_id, year, metric_name)"
+        )
         
-        if not table_exists:
+        if not chunk_columns:
             print("Creating document_chunks table...")
-            cursor.execute("""
+            stmts.append("""
                 CREATE TABLE document_chunks (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     document_id INTEGER NOT NULL,
                     page_number INTEGER,
                     chunk_index INTEGER NOT NULL,
                     text TEXT NOT NULL,
-                    embedding TEXT,
+                    embedding BLOB,
+                    has_mda BOOLEAN,
+                    has_financial BOOLEAN,
+                    has_auditor BOOLEAN,
                     FOREIGN KEY (document_id) REFERENCES documents(id)
                 )
             """)
-            print("[OK] Created document_chunks table")
         else:
             print("[OK] document_chunks table already exists")
+            # Add retrieval keyword flag columns if they don't exist
+            for column in ("has_mda", "has_financial", "has_auditor"):
+                if column not in chunk_columns:
+                    stmts.append(f"ALTER TABLE document_chunks ADD COLUMN {column} BOOLEAN")
+                    print(f"Adding {column} column to document_chunks...")
+                else:
+                    print(f"[OK] {column} column already exists")
+        
+        # Per-document similarity index rows (see app.vector_store)
+        stmts.append("""
+            CREATE TABLE IF NOT EXISTS document_embeddings (
+                document_id INTEGER PRIMARY KEY,
+                dim INTEGER NOT NULL,
+                dtype VARCHAR NOT NULL,
+                chunk_ids BLOB NOT NULL,
+                matrix BLOB NOT NULL,
+                params BLOB NOT NULL,
+                flags BLOB NOT NULL,
+                FOREIGN KEY (document_id) REFERENCES documents(id)
+            )
+        """)
         
-        conn.commit()
+        # WAL persists in the database file, so the app's writes use it too;
+        # it can't be switched inside a transaction, hence before BEGIN
+        cursor.executescript(
+            "PRAGMA journal_mode=WAL;\nBEGIN;\n" + ";\n".join(stmts) + ";\nCOMMIT;"
+        )
+        print("[OK] Ensured indexes on documents and financial_metrics")
+        print("[OK] Ensured document_chunks and document_embeddings tables")
         print("\nMigration completed successfully!")
         
     except Exception as e:
@@ -1,3 +1,5 @@
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
 from app.database import Base, engine, SessionLocal
 from app.models import Company, FinancialMetric
 
@@ -27,22 +29,16 @@ def seed():
         (2024, "net_profit", 70000.0),
     ]
 
-    for year, name, value in demo_metrics:
-        exists = (
-            db.query(FinancialMetric)
-            .filter_by(company_id=ril.id, year=year, metric_name=name)
-            .first()
-        )
-        if not exists:
-            db.add(
-                FinancialMetric(
-                    company_id=ril.id,
-                    year=year,
-                    metric_name=name,
-                    value=value,
-                    unit="INR Cr",
-                )
-            )
+    # One statement for all rows; metrics that are already seeded are left as they are
+    rows = [
+        {"company_id": ril.id, "year": year, "metric_name": name, "value": value, "unit": "INR Cr"}
+        for year, name, value in demo_metrics
+    ]
+    db.execute(
+        sqlite_insert(FinancialMetric)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=["company_id", "year", "metric_name"])
+    )
 
     db.commit()
     db.close()
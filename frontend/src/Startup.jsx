@@ -9,6 +9,11 @@ const companies = [
 
 const roles = ["Analyst", "CEO", "Group Management"];
 
+// How often to check whether an uploaded document has finished parsing
+const PARSE_POLL_INTERVAL_MS = 1500;
+// Give up waiting after this many checks (10 minutes)
+const PARSE_POLL_MAX_ATTEMPTS = 400;
+
 export default function Startup({ onStart, documents = [], onDocumentsReload }) {
   const [selectedCompany, setSelectedCompany] = useState(companies[0].code);
   const [selectedRole, setSelectedRole] = useState(roles[0]);
@@ -72,7 +77,23 @@ export default function Startup({ onStart, documents = [], onDocumentsReload })
         }
       );
 
-      const { document_id, company_name, fiscal_year } = response.data;
+      let { document_id, company_name, fiscal_year, parse_status } = response.data;
+      // The PDF is classified and parsed after the upload returns; wait for it
+      // so the chat opens with the document's name and metrics
+      for (let attempt = 0; parse_status === "pending"; attempt++) {
+        if (attempt >= PARSE_POLL_MAX_ATTEMPTS) {
+          throw new Error("The PDF is taking too long to process. Please try again later.");
+        }
+        await new Promise((resolve) => setTimeout(resolve, PARSE_POLL_INTERVAL_MS));
+        const res = await axios.get(`${BACKEND_BASE_URL}/upload/balance-sheet/${document_id}`);
+        ({ company_name, fiscal_year, parse_status } = res.data);
+        if (parse_status === "rejected") {
+          throw new Error(`Uploaded PDF is not a financial document. ${res.data.rejection_reason || ""}`);
+        }
+      }
+      if (parse_status === "failed") {
+        throw new Error("The PDF could not be parsed. Please try uploading it again.");
+      }
       // Reload documents list after successful upload
       if (onDocumentsReload) {
         onDocumentsReload();